@@ -44,10 +44,18 @@ __contributors__ = {}
 __url__ = ''
 
 from . import config
+from . import api
+from . import capture
+from . import spool
+from . import store
 from . import plugin
 from imp import reload
 # In case we're being reloaded.
 reload(config)
+reload(api)
+reload(capture)
+reload(spool)
+reload(store)
 reload(plugin)
 # Add more reloads here if you add third-party modules and want them to be
 # reloaded when this plugin is reloaded.  Don't forget to import them as well!
@@ -0,0 +1,271 @@
+###
+# Copyright (c) 2015, Moritz Lipp
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Client of the REST API of Gitlab instances, used to add to announcements what
+webhooks do not contain.
+
+Connections are kept alive and reused, responses are cached for a while and
+identical requests made while one is in flight wait for its response instead
+of being sent again. Every call gives up after a timeout, so that an
+unresponsive instance does not hold announcements back for long.
+"""
+
+import collections
+import http.client
+import json
+import socket
+import threading
+import time
+import urllib.parse
+
+# Number of bytes of a response read at a time
+READ_SIZE = 16384
+
+
+class ApiError(Exception):
+    pass
+
+
+class ApiTimeout(ApiError):
+    pass
+
+
+def instance_url(project_url, path=None):
+    """Returns the url of the Gitlab instance hosting the project at
+    <project_url>, whose path_with_namespace is <path> if known"""
+    parts = urllib.parse.urlsplit(project_url)
+    prefix = ''
+    project_path = parts.path.rstrip('/')
+    if path and project_path.endswith('/' + path):
+        # Gitlab may be served from a subdirectory.
+        prefix = project_path[:-len(path) - 1]
+    return '%s://%s%s' % (parts.scheme, parts.netloc, prefix)
+
+
+class ConnectionPool(object):
+
+    """Keeps up to <size> idle connections per instance"""
+
+    def __init__(self, size):
+        self._size = size
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def get(self, scheme, netloc, timeout):
+        """Returns a connection, and whether it was used before"""
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=timeout), False
+        return http.client.HTTPConnection(netloc, timeout=timeout), False
+
+    def put(self, scheme, netloc, connection):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self._size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+class _Call(object):
+
+    """A request in flight"""
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Client(object):
+
+    """Reads the projects of Gitlab instances with the token returned by
+    <token>, giving up on a call after <timeout> seconds and caching up to
+    <cache_size> responses for <cache_ttl> seconds"""
+
+    def __init__(self, token, timeout, cache_size, cache_ttl, pool_size):
+        self._token = token
+        self._timeout = timeout
+        self._cache_size = cache_size
+        self._cache_ttl = cache_ttl
+        self._pool = ConnectionPool(pool_size)
+        self._lock = threading.Lock()
+        # (instance url, project id, resource) -> (expiry, response), least
+        # recently used first
+        self._cache = collections.OrderedDict()
+        self._calls = {}
+        # Number of calls by result
+        self.counts = collections.OrderedDict(
+            (result, 0)
+            for result in ('hit', 'miss', 'coalesced', 'error', 'timeout'))
+
+    def _count(self, result):
+        with self._lock:
+            self.counts[result] += 1
+
+    def get(self, base_url, project_id, resource):
+        """Returns the decoded response to a GET of <resource> of the project
+        <project_id> of the instance at <base_url>, e.g.
+        'merge_requests/1/approvals'; raises ApiError if it fails"""
+        key = (base_url, project_id, resource)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                if cached[0] > time.monotonic():
+                    self._cache.move_to_end(key)
+                    self.counts['hit'] += 1
+                    return cached[1]
+                del self._cache[key]
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.counts['coalesced'] += 1
+
+        if not leader:
+            if not call.done.wait(self._timeout):
+                self._count('timeout')
+                raise ApiTimeout('Timed out waiting for %s' % resource)
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._request(
+                base_url, '/api/v4/projects/%s/%s' % (project_id, resource))
+        except ApiTimeout as e:
+            self._count('timeout')
+            call.error = e
+            raise
+        except ApiError as e:
+            self._count('error')
+            call.error = e
+            raise
+        else:
+            with self._lock:
+                self.counts['miss'] += 1
+                self._cache[key] = (time.monotonic() + self._cache_ttl,
+                                    call.result)
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def _request(self, base_url, path):
+        deadline = time.monotonic() + self._timeout
+        parts = urllib.parse.urlsplit(base_url)
+        path = parts.path.rstrip('/') + path
+        headers = {'Accept': 'application/json'}
+        token = self._token()
+        if token:
+            headers['PRIVATE-TOKEN'] = token
+        for attempt in range(2):
+            connection, reused = self._pool.get(parts.scheme, parts.netloc,
+                                                self._timeout)
+            try:
+                connection.timeout = self._remaining(deadline)
+                if connection.sock is not None:
+                    connection.sock.settimeout(connection.timeout)
+                connection.request('GET', path, headers=headers)
+                # The connection drops its socket once a response that closes
+                # it is received.
+                sock = connection.sock
+                sock.settimeout(self._remaining(deadline))
+                response = connection.getresponse()
+                body = self._read(sock, response, deadline)
+            except socket.timeout:
+                connection.close()
+                raise ApiTimeout('Timed out requesting %s' % path)
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                if reused and attempt == 0 and \
+                        isinstance(e, (http.client.RemoteDisconnected,
+                                       ConnectionError)):
+                    # The instance closed the connection while it was idle.
+                    continue
+                raise ApiError('Failed to request %s: %s' % (path, e))
+            break
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._pool.put(parts.scheme, parts.netloc, connection)
+        if response.status != 200:
+            raise ApiError('Failed to request %s: HTTP %d' %
+                           (path, response.status))
+        try:
+            return json.loads(body.decode('utf-8'))
+        except ValueError as e:
+            raise ApiError('Invalid response to %s: %s' % (path, e))
+
+    def _read(self, sock, response, deadline):
+        """Returns the body of <response>, read before <deadline>"""
+        # The timeout of the socket applies to each read, so the deadline is
+        # checked between them: a response sent a few bytes at a time
+        # cannot outlast it.
+        chunks = []
+        while True:
+            sock.settimeout(self._remaining(deadline))
+            chunk = response.read1(READ_SIZE)
+            if not chunk:
+                # read1() leaves a fully read response open, and the
+                # connection waits for it to be closed.
+                response.close()
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def _remaining(self, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout()
+        return remaining
+
+    def close(self):
+        self._pool.close()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
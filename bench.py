@@ -0,0 +1,358 @@
+###
+# Copyright (c) 2015, Moritz Lipp
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Benchmarks of the webhook processing. Run them from the directory that
+contains the plugin, e.g.: python -m Gitlab.bench, or to replay a capture
+recorded by the plugin: python -m Gitlab.bench replay --capture <file>
+"""
+
+import argparse
+import json
+import time
+import timeit
+import tracemalloc
+
+import supybot.conf as conf
+import supybot.httpserver as httpserver
+import supybot.ircutils as ircutils
+import supybot.world as world
+
+from . import capture
+from . import plugin
+
+
+HOMEPAGE = 'https://gitlab.example.com/group/project%d'
+
+
+class FakeState(object):
+
+    def __init__(self, channels):
+        self.channels = ircutils.IrcDict((channel, None)
+                                         for channel in channels)
+        self.supported = {'targmax': 'PRIVMSG:4,NOTICE:4'}
+
+
+class FakeIrc(object):
+
+    """Stands in for an Irc object and counts the queued messages"""
+
+    def __init__(self, network, channels):
+        self.network = network
+        self.state = FakeState(channels)
+        self.queued = 0
+
+    def queueMsg(self, msg):
+        self.queued += 1
+
+
+class FakeRequest(object):
+
+    """Stands in for the HTTP request handler passed to doPost"""
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.code = None
+
+    def send_response(self, code):
+        self.code = code
+
+    def send_header(self, name, value):
+        pass
+
+    def end_headers(self):
+        pass
+
+    class wfile(object):
+        @staticmethod
+        def write(data):
+            pass
+
+
+def push_payload(project, commits):
+    homepage = HOMEPAGE % project
+    return {
+        'object_kind': 'push',
+        'before': '95790bf891e76fee5e1747ab589903a6a1f80f22',
+        'after': 'da1560886d4f094c3e6c9ef40349f7d38b5d27d7',
+        'ref': 'refs/heads/master',
+        'user_name': 'John Smith',
+        'project_id': project,
+        'repository': {'name': 'project%d' % project, 'homepage': homepage},
+        'total_commits_count': commits,
+        'commits': [{
+            'id': '%040x' % i,
+            'message': 'Change %d\n\nWith a longer description.' % i,
+            'url': '%s/commit/%040x' % (homepage, i),
+            'author': {'name': 'Jordi Mallach', 'email': 'jordi@example.com'},
+            'added': ['CHANGELOG'],
+            'modified': ['app/controller/application.rb'],
+            'removed': [],
+        } for i in range(commits)],
+    }
+
+
+def object_payload(project, kind):
+    homepage = HOMEPAGE % project
+    attributes = {
+        'id': 301, 'iid': 23, 'title': 'New API: create/update/delete file',
+        'action': 'open', 'project_id': project,
+        'target_project_id': project,
+        'url': '%s/%s/23' % (homepage, kind),
+        'target': {'web_url': homepage, 'http_url': homepage + '.git'},
+    }
+    return {
+        'object_kind': kind,
+        'user': {'name': 'Administrator'},
+        'project_id': project,
+        'repository': {'name': 'project%d' % project, 'homepage': homepage},
+        'object_attributes': attributes,
+    }
+
+
+def note_payload(project):
+    payload = object_payload(project, 'issues')
+    payload['object_attributes']['noteable_type'] = 'Issue'
+    payload['issue'] = dict(payload['object_attributes'])
+    return payload
+
+
+SCENARIOS = [
+    ('push-1', 'Push Hook', lambda project: push_payload(project, 1)),
+    ('push-20', 'Push Hook', lambda project: push_payload(project, 20)),
+    ('push-1000', 'Push Hook', lambda project: push_payload(project, 1000)),
+    ('issue', 'Issue Hook', lambda project: object_payload(project, 'issues')),
+    ('merge-request', 'Merge Request Hook',
+     lambda project: object_payload(project, 'merge_requests')),
+    ('note', 'Note Hook', note_payload),
+]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def setup_plugin(args, urls=None):
+    """Loads the plugin on a fake network whose channels subscribe to
+    <args.projects> projects, or to the projects at <urls>, each of them in
+    <args.subscribers> channels"""
+    channels = ['#bench%d' % i for i in range(args.channels)]
+    irc = FakeIrc('bench', channels)
+    world.ircs.append(irc)
+    # The benchmark talks to the webhook service directly.
+    hook, httpserver.hook = httpserver.hook, lambda *args: None
+    try:
+        instance = plugin.Gitlab(irc)
+    finally:
+        httpserver.hook = hook
+    if urls is None:
+        urls = [HOMEPAGE % project for project in range(args.projects)]
+    subscriptions = dict((channel, {}) for channel in channels)
+    for project, url in enumerate(urls):
+        for i in range(args.subscribers):
+            channel = channels[(project + i) % len(channels)]
+            subscriptions[channel]['project%d' % project] = url
+    for channel, projects in subscriptions.items():
+        instance._save_projects(projects, channel)
+    return irc, instance
+
+
+def teardown_plugin(irc, instance):
+    for channel in irc.state.channels:
+        instance._save_projects({}, channel)
+    instance._webhook.stop()
+    instance._templates.close()
+    instance._settings.close()
+    instance._store.close()
+    world.ircs.remove(irc)
+
+
+def bench_webhooks(args):
+    """Posts generated webhooks through doPost and reports throughput,
+    latency percentiles, peak allocations and queued IRC messages."""
+    irc, instance = setup_plugin(args)
+    service = instance._webhook
+    # The same bodies are posted over and over again.
+    dedupe = conf.supybot.plugins.Gitlab.dedupe.ttl.context(0)
+    dedupe.__enter__()
+    print('%d channels, %d projects, %d subscriber(s) per project' %
+          (args.channels, args.projects, args.subscribers))
+    print('%-14s %10s %10s %10s %12s %10s' %
+          ('scenario', 'events/s', 'p50 (ms)', 'p99 (ms)', 'peak (KiB)',
+           'msgs/event'))
+    try:
+        for name, event_type, generate in SCENARIOS:
+            bodies = [json.dumps(generate(i % args.projects)).encode('utf-8')
+                      for i in range(min(args.events, args.projects))]
+            headers = {'X-Gitlab-Event': event_type}
+            latencies = []
+            irc.queued = 0
+            start = time.perf_counter()
+            for i in range(args.events):
+                request = FakeRequest(headers)
+                before = time.perf_counter()
+                service.doPost(request, '/bench', bodies[i % len(bodies)])
+                latencies.append(time.perf_counter() - before)
+                assert request.code in (200, 202), request.code
+            elapsed = time.perf_counter() - start
+            queued = irc.queued
+
+            tracemalloc.start()
+            service.doPost(FakeRequest(headers), '/bench', bodies[0])
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            print('%-14s %10.0f %10.3f %10.3f %12.1f %10.1f' %
+                  (name, args.events / elapsed,
+                   percentile(latencies, 0.5) * 1e3,
+                   percentile(latencies, 0.99) * 1e3,
+                   peak / 1024., queued / float(args.events)))
+    finally:
+        dedupe.__exit__(None, None, None)
+        teardown_plugin(irc, instance)
+
+
+def bench_templates(args):
+    """Compares rendering a commit line with a registry lookup and
+    str.format against the cached, parsed template."""
+    group = conf.supybot.plugins.Gitlab
+    channel = '#bench'
+    commit = {
+        'project': {'id': 15, 'name': 'diaspora',
+                    'url': 'https://example.com/mike/diaspora'},
+        'id': 'b6568db1bc1dcd7f8b4d5a946b0b91f9dacd7327',
+        'short_id': 'b6568db1bc',
+        'short_message': 'Update Catalan translation to e38cb41.',
+        'author': {'name': 'Jordi Mallach'},
+    }
+
+    def uncached():
+        format_string = str(group.get('format').get('commit')
+                            .getSpecific(channel=channel)())
+        return format_string.format(**commit)
+
+    templates = plugin.ChannelValueCache(
+        group, lambda value: plugin.Template(str(value)))
+
+    def cached():
+        return templates.get('format.commit', channel).format(commit)
+
+    assert uncached() == cached()
+    for name, func in (('registry + str.format', uncached),
+                       ('cached template', cached)):
+        runs = min(timeit.repeat(func, number=args.number, repeat=5))
+        print('%-24s %8.2f us/commit' % (name, runs / args.number * 1e6))
+    templates.close()
+
+
+def captured_urls(path):
+    """Returns the urls of the projects of the webhooks captured in
+    <path>"""
+    event_types = dict((event_type.name, event_type)
+                       for event_type in plugin.default_event_types())
+    urls = set()
+    for record in capture.read(path):
+        event_type = event_types.get(record['headers'].get('X-Gitlab-Event'))
+        if event_type is None:
+            continue
+        try:
+            urls.add(event_type.project_url(
+                json.loads(capture.body(record))))
+        except (KeyError, TypeError, ValueError):
+            pass
+    return sorted(urls)
+
+
+def bench_replay(args):
+    """Replays the webhooks captured in <args.capture> against a fake
+    network whose channels subscribe to the captured projects, and reports
+    the throughput and the queued IRC messages."""
+    if not args.capture:
+        print('skipped: no --capture given')
+        return
+    urls = captured_urls(args.capture)
+    irc, instance = setup_plugin(args, urls)
+    gitlab = plugin.GitlabHandler(instance)
+    print('%d channels, %d captured projects, %d subscriber(s) per project, '
+          'speed %s' % (args.channels, len(urls), args.subscribers,
+                        args.speed or 'max'))
+    try:
+        count, errors, elapsed = instance._webhook.replay(
+            args.capture, args.speed, gitlab, irc.network)
+    finally:
+        teardown_plugin(irc, instance)
+    print('%d webhooks in %.2f s (%.0f events/s), %d errors, %d messages '
+          '(%.1f msgs/event)' %
+          (count, elapsed, count / elapsed if elapsed else 0, errors,
+           irc.queued, irc.queued / float(count) if count else 0))
+
+
+BENCHMARKS = {
+    'replay': bench_replay,
+    'templates': bench_templates,
+    'webhooks': bench_webhooks,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='one of %s (default: all)' %
+                        ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--number', type=int, default=10000,
+                        help='iterations per template measurement')
+    parser.add_argument('--events', type=int, default=200,
+                        help='webhooks posted per scenario')
+    parser.add_argument('--channels', type=int, default=100,
+                        help='channels the bot is in')
+    parser.add_argument('--projects', type=int, default=1000,
+                        help='subscribed projects')
+    parser.add_argument('--subscribers', type=int, default=1,
+                        help='channels subscribed to each project')
+    parser.add_argument('--capture', metavar='FILE',
+                        help='capture replayed by the replay benchmark')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='replay speed relative to the capture, 0 '
+                        'replaying as fast as possible (default)')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmark(s): %s' % ', '.join(sorted(unknown)))
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        print('== %s' % name)
+        BENCHMARKS[name](args)
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
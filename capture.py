@@ -0,0 +1,133 @@
+###
+# Copyright (c) 2015, Moritz Lipp
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Captures of the webhooks received by the plugin, to replay real traffic.
+
+A capture is a gzip-compressed file of JSON lines, one per webhook, with the
+time it was received, the network it was sent for (null for every network),
+its headers and its body. Captures contain the secret tokens sent by Gitlab.
+"""
+
+import base64
+import gzip
+import json
+import threading
+import time
+import zlib
+
+
+class Recorder(object):
+
+    """Appends webhooks to the capture at <path> until it reaches <max_size>
+    compressed bytes"""
+
+    def __init__(self, path, max_size, flush_interval=1):
+        self._max_size = max_size
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._raw = open(path, 'ab')
+        # Each opening starts a new gzip member, which readers concatenate.
+        self._file = gzip.GzipFile(fileobj=self._raw, mode='ab')
+        self._flushed = time.monotonic()
+        self.recorded = 0
+        self.dropped = 0
+
+    def record(self, network, headers, body):
+        record = {'time': time.time(), 'network': network,
+                  'headers': headers}
+        try:
+            record['body'] = body.decode('utf-8')
+        except UnicodeDecodeError:
+            record['body64'] = base64.b64encode(body).decode('ascii')
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        with self._lock:
+            if self._file is None or self._raw.tell() >= self._max_size:
+                self.dropped += 1
+                return
+            self._file.write(line)
+            self.recorded += 1
+            now = time.monotonic()
+            if now - self._flushed >= self._flush_interval:
+                # Lets the capture be read while it is recorded.
+                self._file.flush(zlib.Z_SYNC_FLUSH)
+                self._raw.flush()
+                self._flushed = now
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._raw.close()
+                self._file = None
+
+
+def read(path):
+    """Yields the records of the capture at <path>, up to the last complete
+    one if it is still being recorded"""
+    with gzip.open(path, 'rb') as fd:
+        while True:
+            try:
+                line = fd.readline()
+            except (EOFError, zlib.error):
+                return
+            if not line.endswith(b'\n'):
+                return
+            yield json.loads(line.decode('utf-8'))
+
+
+def body(record):
+    """Returns the body of a webhook as it was received"""
+    if 'body64' in record:
+        return base64.b64decode(record['body64'])
+    return record['body'].encode('utf-8')
+
+
+def replay(records, process, speed=1.0, sleep=time.sleep):
+    """Passes <records> to <process>, spaced like they were received divided
+    by <speed>, or as fast as possible if <speed> is 0; returns the number of
+    records and the elapsed seconds"""
+    count = 0
+    start = time.monotonic()
+    first = None
+    for record in records:
+        if first is None:
+            first = record['time']
+        elif speed:
+            delay = (record['time'] - first) / speed - \
+                (time.monotonic() - start)
+            if delay > 0:
+                sleep(delay)
+        process(record)
+        count += 1
+    return count, time.monotonic() - start
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -48,11 +48,139 @@ def configure(advanced):
     conf.registerPlugin('Gitlab', True)
 
 
+class QueuePolicy(registry.OnlySomeStrings):
+    """Valid values are 'reject' and 'drop-oldest'."""
+    validStrings = ('reject', 'drop-oldest')
+
+
 Gitlab = conf.registerPlugin('Gitlab')
 
 # Settings
 conf.registerChannelValue(Gitlab, 'projects',
-    registry.Json({}, _("""List of projects""")))
+    registry.Json({}, _("""Projects to announce to the channel, by slug. Each project is either its url or an object with its 'url' and settings. Projects set here are moved to the database of the plugin when it is loaded, or when this value is changed."""), private=True))
+conf.registerGlobalValue(Gitlab, 'pageSize',
+    registry.PositiveInteger(10, _("""Number of projects listed at a time by the 'gitlab project list' command.""")))
+
+# Commits
+conf.registerGroup(Gitlab, 'commits')
+
+conf.registerChannelValue(Gitlab.commits, 'max',
+    registry.NonNegativeInteger(0, _("""Maximum number of commits announced for a single push; the remaining commits are summarized in one line. 0 means no limit.""")))
+conf.registerChannelValue(Gitlab.commits, 'coalesce',
+    registry.Boolean(False, _("""Determines whether several commits are announced in a single message as long as it fits in one IRC line.""")))
+
+# Pipelines and jobs
+conf.registerGroup(Gitlab, 'pipelines')
+conf.registerGroup(Gitlab, 'jobs')
+
+conf.registerChannelValue(Gitlab.pipelines, 'announce',
+    registry.SpaceSeparatedListOfStrings(['failed', 'fixed'], _("""Pipeline status changes that are announced: success, failed, canceled and fixed (success after a failure on the same ref).""")))
+conf.registerChannelValue(Gitlab.jobs, 'announce',
+    registry.SpaceSeparatedListOfStrings(['failed'], _("""Job status changes that are announced: success, failed, canceled and fixed (success after a failure of the same job on the same ref).""")))
+conf.registerGlobalValue(Gitlab.pipelines, 'history',
+    registry.PositiveInteger(1000, _("""Number of (project, ref) pairs and jobs whose last status is remembered to detect fixed pipelines and jobs. Changes take effect when the plugin is reloaded.""")))
+
+# Coalescing
+conf.registerGroup(Gitlab, 'coalesce')
+
+conf.registerChannelValue(Gitlab.coalesce, 'window',
+    registry.NonNegativeInteger(0, _("""Number of seconds during which repeated issue and merge request events of the same object and action are collapsed into a single announcement, sent when the window ends. 0 announces every event immediately.""")))
+conf.registerChannelValue(Gitlab.coalesce, 'actions',
+    registry.SpaceSeparatedListOfStrings(['update'], _("""Issue and merge request actions that are collapsed.""")))
+
+# Webhook
+conf.registerGroup(Gitlab, 'webhook')
+
+conf.registerGlobalValue(Gitlab.webhook, 'maxSize',
+    registry.NonNegativeInteger(5 * 1024 * 1024, _("""Maximum size in bytes of a webhook body; larger webhooks are rejected before they are decoded. 0 means no limit.""")))
+conf.registerNetworkValue(Gitlab.webhook, 'token',
+    registry.String('', _("""Secret token Gitlab must send with the webhooks of this network, in the X-Gitlab-Token header. When empty, a token sent by Gitlab must be the token of one of the subscribed projects."""), private=True))
+conf.registerGlobalValue(Gitlab.webhook, 'requireToken',
+    registry.Boolean(False, _("""Determines whether webhooks without a secret token are rejected.""")))
+
+# Deduplication
+conf.registerGroup(Gitlab, 'dedupe')
+
+conf.registerGlobalValue(Gitlab.dedupe, 'ttl',
+    registry.NonNegativeInteger(3600, _("""Number of seconds during which a webhook delivered again by Gitlab is ignored. 0 disables deduplication.""")))
+conf.registerGlobalValue(Gitlab.dedupe, 'size',
+    registry.PositiveInteger(10000, _("""Maximum number of delivered webhooks remembered for deduplication. Changes take effect when the plugin is reloaded.""")))
+
+# Spool
+conf.registerGroup(Gitlab, 'spool')
+
+conf.registerGlobalValue(Gitlab.spool, 'enabled',
+    registry.Boolean(False, _("""Determines whether webhooks received for a configured network the bot is not connected to are stored on disk and announced once it is back. Changes take effect when the plugin is reloaded.""")))
+conf.registerGlobalValue(Gitlab.spool, 'maxAge',
+    registry.PositiveInteger(86400, _("""Number of seconds after which spooled webhooks are dropped instead of being announced.""")))
+conf.registerGlobalValue(Gitlab.spool, 'maxSize',
+    registry.PositiveInteger(50 * 1024 * 1024, _("""Maximum size in bytes of the spool of a network; the oldest webhooks are dropped when it is exceeded.""")))
+conf.registerGlobalValue(Gitlab.spool, 'segmentSize',
+    registry.PositiveInteger(1024 * 1024, _("""Size in bytes after which a new spool file is started.""")))
+conf.registerGlobalValue(Gitlab.spool, 'syncInterval',
+    registry.PositiveInteger(1, _("""Number of seconds between two flushes of the spool to disk and two checks for networks that are back. Changes take effect when the plugin is reloaded.""")))
+
+# Capture
+conf.registerGroup(Gitlab, 'capture')
+
+conf.registerGlobalValue(Gitlab.capture, 'enabled',
+    registry.Boolean(False, _("""Determines whether the webhooks received are recorded, with their secret tokens, to be replayed by the replay command. Changes take effect when the plugin is reloaded.""")))
+conf.registerGlobalValue(Gitlab.capture, 'file',
+    registry.String('Gitlab.capture.jsonl.gz', _("""Name of the file of the data directory webhooks are recorded to. Changes take effect when the plugin is reloaded.""")))
+conf.registerGlobalValue(Gitlab.capture, 'maxSize',
+    registry.PositiveInteger(100 * 1024 * 1024, _("""Size in bytes after which webhooks are no longer recorded. Changes take effect when the plugin is reloaded.""")))
+
+# Queue
+conf.registerGroup(Gitlab, 'queue')
+
+conf.registerGlobalValue(Gitlab.queue, 'enabled',
+    registry.Boolean(False, _("""Determines whether webhooks are acknowledged immediately and processed by a pool of workers. Changes take effect when the plugin is reloaded.""")))
+conf.registerGlobalValue(Gitlab.queue, 'size',
+    registry.PositiveInteger(1000, _("""Maximum number of webhooks waiting to be processed.""")))
+conf.registerGlobalValue(Gitlab.queue, 'workers',
+    registry.PositiveInteger(2, _("""Number of workers processing queued webhooks.""")))
+conf.registerGlobalValue(Gitlab.queue, 'policy',
+    QueuePolicy('reject', _("""Determines what happens when the queue is full: 'reject' answers with 503 so Gitlab retries later, 'drop-oldest' discards the oldest queued webhook.""")))
+
+# Outbound scheduler
+conf.registerGroup(Gitlab, 'outbound')
+
+conf.registerGlobalValue(Gitlab.outbound, 'enabled',
+    registry.Boolean(False, _("""Determines whether announcements are sent by a scheduler that sends the most important ones first and takes turns between channels, instead of in the order they were made. Changes take effect when the plugin is reloaded.""")))
+conf.registerGlobalValue(Gitlab.outbound, 'rate',
+    registry.Float(0, _("""Number of announcements per second sent to each network by the scheduler. 0 or less follows supybot.protocols.irc.throttleTime.""")))
+conf.registerGlobalValue(Gitlab.outbound, 'burst',
+    registry.PositiveInteger(2, _("""Number of announcements the scheduler may send to a network at once after it was idle. Changes take effect when the plugin is reloaded.""")))
+conf.registerGlobalValue(Gitlab.outbound, 'urgent',
+    registry.SpaceSeparatedListOfStrings(['merge-request-merge', 'pipeline-failed', 'job-failed'], _("""Formats of the announcements sent before the others.""")))
+conf.registerGlobalValue(Gitlab.outbound, 'bulk',
+    registry.SpaceSeparatedListOfStrings(['commit', 'commits-more'], _("""Formats of the announcements sent after the others.""")))
+
+# Digest
+conf.registerGroup(Gitlab, 'digest')
+
+conf.registerChannelValue(Gitlab.digest, 'interval',
+    registry.NonNegativeInteger(0, _("""Number of seconds during which the events announced to the channel are counted and then summarized in one line per project, instead of being announced one by one. 0 disables the digest.""")))
+conf.registerGlobalValue(Gitlab.digest, 'projects',
+    registry.PositiveInteger(10, _("""Maximum number of projects summarized in a digest; the events of the others are only counted.""")))
+conf.registerGlobalValue(Gitlab.digest, 'authors',
+    registry.PositiveInteger(3, _("""Number of most active authors listed for each project of a digest.""")))
+
+# API
+conf.registerGroup(Gitlab, 'api')
+
+conf.registerGlobalValue(Gitlab.api, 'enabled',
+    registry.Boolean(False, _("""Determines whether announcements are completed with data read from the API of the Gitlab instances, like the status of the pipeline of a push or the approvals of a merge request. Changes take effect when the plugin is reloaded.""")))
+conf.registerGlobalValue(Gitlab.api, 'token',
+    registry.String('', _("""Access token used to read the API, with the read_api scope."""), private=True))
+conf.registerGlobalValue(Gitlab.api, 'timeout',
+    registry.PositiveFloat(1.0, _("""Number of seconds after which an announcement is made without the data of the API. Changes take effect when the plugin is reloaded.""")))
+conf.registerGlobalValue(Gitlab.api, 'cacheTtl',
+    registry.PositiveInteger(60, _("""Number of seconds the responses of the API are reused. Changes take effect when the plugin is reloaded.""")))
+conf.registerGlobalValue(Gitlab.api, 'cacheSize',
+    registry.PositiveInteger(1000, _("""Maximum number of cached responses of the API. Changes take effect when the plugin is reloaded.""")))
+conf.registerGlobalValue(Gitlab.api, 'poolSize',
+    registry.PositiveInteger(4, _("""Maximum number of idle connections kept open to each Gitlab instance. Changes take effect when the plugin is reloaded.""")))
 
 # Format
 conf.registerGroup(Gitlab, 'format')
@@ -62,10 +190,29 @@ conf.registerChannelValue(Gitlab, 'use-notices',
 conf.registerChannelValue(Gitlab.format, 'push',
     registry.String(_("""\x02[{project[name]}]\x02 {user_name} pushed \x02{total_commits_count} commit(s)\x02 to \x02{ref}\x02:"""),
                     _("""Format for push events.""")))
+conf.registerChannelValue(Gitlab.format, 'push-enriched',
+    registry.String(_("""\x02[{project[name]}]\x02 {user_name} pushed \x02{total_commits_count} commit(s)\x02 to \x02{ref}\x02 (pipeline \x02{api[pipeline][status]}\x02):"""),
+                    _("""Format for push events when the API provides the pipeline of the pushed commit. Empty to always use the push format.""")))
 conf.registerChannelValue(Gitlab.format, 'commit',
     registry.String(_("""\x02[{project[name]}]\x02 {short_id} \x02{short_message}\x02 by {author[name]}"""),
                     _("""Format for commits.""")))
 
+conf.registerChannelValue(Gitlab.format, 'commits-more',
+    registry.String(_("""\x02[{project[name]}]\x02 ...and {count} more commit(s): {compare_url}"""),
+                    _("""Format for the commits of a push that are not announced.""")))
+
+conf.registerChannelValue(Gitlab.format, 'coalesced',
+    registry.String(_("""{message} \x02({count}x)\x02"""),
+                    _("""Format for announcements that collapse several events, with the announcement of the latest event as *message*.""")))
+
+conf.registerChannelValue(Gitlab.format, 'digest',
+    registry.String(_("""\x02[{project[name]}]\x02 {summary}"""),
+                    _("""Format for the summary of the events of a project in digest mode, with the counters as *counts* (e.g. counts[pushes]), the most active authors as *authors* and both as *summary*.""")))
+
+conf.registerChannelValue(Gitlab.format, 'digest-more',
+    registry.String(_("""...and {count} event(s) of other projects"""),
+                    _("""Format for the number of events of the projects left out of a digest.""")))
+
 conf.registerChannelValue(Gitlab.format, 'tag',
     registry.String(_("""\x02[{project[name]}]\x02 {user_name} created a new tag {ref}"""),
                     _("""Format for tag push events.""")))
@@ -86,9 +233,15 @@ conf.registerChannelValue(Gitlab.format, 'issue-reopen',
 conf.registerChannelValue(Gitlab.format, 'merge-request-open',
     registry.String(_("""\x02[{project[name]}]\x02 Merge request \x02#{merge_request[id]} {merge_request[title]}\x02 created by {user[name]} {merge_request[url]}"""),
                     _("""Format for merge-request/open events.""")))
+conf.registerChannelValue(Gitlab.format, 'merge-request-open-enriched',
+    registry.String(_("""\x02[{project[name]}]\x02 Merge request \x02#{merge_request[id]} {merge_request[title]}\x02 created by {user[name]} ({api[approvals][count]}/{api[approvals][required]} approvals) {merge_request[url]}"""),
+                    _("""Format for merge-request/open events when the API provides the approvals of the merge request. Empty to always use the merge-request-open format.""")))
 conf.registerChannelValue(Gitlab.format, 'merge-request-update',
     registry.String(_("""\x02[{project[name]}]\x02 Merge request \x02#{merge_request[id]} {merge_request[title]}\x02 updated by {user[name]} {merge_request[url]}"""),
                     _("""Format for merge-request/open events.""")))
+conf.registerChannelValue(Gitlab.format, 'merge-request-update-enriched',
+    registry.String(_("""\x02[{project[name]}]\x02 Merge request \x02#{merge_request[id]} {merge_request[title]}\x02 updated by {user[name]} ({api[approvals][count]}/{api[approvals][required]} approvals) {merge_request[url]}"""),
+                    _("""Format for merge-request/update events when the API provides the approvals of the merge request. Empty to always use the merge-request-update format.""")))
 conf.registerChannelValue(Gitlab.format, 'merge-request-close',
     registry.String(_("""\x02[{project[name]}]\x02 Merge request \x02#{merge_request[id]} {merge_request[title]}\x02 closed by {user[name]} {merge_request[url]}"""),
                     _("""Format for merge-request/open events.""")))
@@ -111,5 +264,31 @@ conf.registerChannelValue(Gitlab.format, 'note-issue',
 conf.registerChannelValue(Gitlab.format, 'note-snippet',
     registry.String(_("""\x02[{project[name]}]\x02 {user[name]} commented on Snippet \x02#{snippet[id]} {snippet[title]}\x02 {note[url]}"""),
                     _("""Format for note/snippet events.""")))
+conf.registerChannelValue(Gitlab.format, 'pipeline-success',
+    registry.String(_("""\x02[{project[name]}]\x02 Pipeline \x02#{pipeline[id]}\x02 on {pipeline[ref]} succeeded {pipeline[url]}"""),
+                    _("""Format for successful pipelines.""")))
+conf.registerChannelValue(Gitlab.format, 'pipeline-failed',
+    registry.String(_("""\x02[{project[name]}]\x02 Pipeline \x02#{pipeline[id]}\x02 on {pipeline[ref]} failed {pipeline[url]}"""),
+                    _("""Format for failed pipelines.""")))
+conf.registerChannelValue(Gitlab.format, 'pipeline-canceled',
+    registry.String(_("""\x02[{project[name]}]\x02 Pipeline \x02#{pipeline[id]}\x02 on {pipeline[ref]} canceled {pipeline[url]}"""),
+                    _("""Format for canceled pipelines.""")))
+conf.registerChannelValue(Gitlab.format, 'pipeline-fixed',
+    registry.String(_("""\x02[{project[name]}]\x02 Pipeline \x02#{pipeline[id]}\x02 on {pipeline[ref]} fixed {pipeline[url]}"""),
+                    _("""Format for successful pipelines after a failure on the same ref.""")))
+
+conf.registerChannelValue(Gitlab.format, 'job-success',
+    registry.String(_("""\x02[{project[name]}]\x02 Job \x02{build_name}\x02 ({build_stage}) on {ref} succeeded {job_url}"""),
+                    _("""Format for successful jobs.""")))
+conf.registerChannelValue(Gitlab.format, 'job-failed',
+    registry.String(_("""\x02[{project[name]}]\x02 Job \x02{build_name}\x02 ({build_stage}) on {ref} failed {job_url}"""),
+                    _("""Format for failed jobs.""")))
+conf.registerChannelValue(Gitlab.format, 'job-canceled',
+    registry.String(_("""\x02[{project[name]}]\x02 Job \x02{build_name}\x02 ({build_stage}) on {ref} canceled {job_url}"""),
+                    _("""Format for canceled jobs.""")))
+conf.registerChannelValue(Gitlab.format, 'job-fixed',
+    registry.String(_("""\x02[{project[name]}]\x02 Job \x02{build_name}\x02 ({build_stage}) on {ref} fixed {job_url}"""),
+                    _("""Format for successful jobs after a failure of the same job on the same ref.""")))
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -28,15 +28,36 @@
 
 ###
 
+import bisect
+import collections
+import fnmatch
+import functools
+import hashlib
+import hmac
 import json
-
-from supybot.commands import wrap
+import math
+import operator
+import os
+import re
+import threading
+import time
+
+from supybot.commands import any, getopts, optional, wrap
+import supybot.conf as conf
+import supybot.utils as utils
 import supybot.ircdb as ircdb
 import supybot.ircmsgs as ircmsgs
+import supybot.ircutils as ircutils
 import supybot.callbacks as callbacks
 import supybot.log as log
+import supybot.schedule as schedule
 import supybot.httpserver as httpserver
 import supybot.world as world
+
+from . import api
+from . import capture
+from . import spool
+from . import store
 try:
     from supybot.i18n import PluginInternationalization
     from supybot.i18n import internationalizeDocstring
@@ -51,6 +72,896 @@ except ImportError:
         return x
 
 
+def normalize_project_url(url):
+    """Returns the key under which a project url is stored in the routing
+    index, ignoring the scheme, case, a trailing slash and a '.git' suffix."""
+    url = url.strip().lower()
+    if '://' in url:
+        url = url.split('://', 1)[1]
+    url = url.rstrip('/')
+    if url.endswith('.git'):
+        url = url[:-4]
+    return url
+
+
+def project_host(url):
+    """Returns the normalized host of the Gitlab instance of a project"""
+    return normalize_project_url(url).split('/', 1)[0]
+
+
+def _strip_object_path(url):
+    """Returns the project part of an issue or merge request url"""
+    for marker in ('/-/', '/issues/', '/merge_requests/'):
+        if marker in url:
+            return url.split(marker, 1)[0]
+    return url
+
+
+def project_settings(entry):
+    """Returns the settings of a subscribed project as a dict; projects
+    used to be stored as their url only"""
+    if isinstance(entry, dict):
+        return entry
+    return {'url': entry}
+
+
+def project_entry(settings):
+    """Returns how the settings of a subscribed project are stored"""
+    if len(settings) == 1:
+        return settings['url']
+    return settings
+
+
+def token_digest(token):
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+
+def network_token_matches(network, token):
+    """Returns whether <token> is the webhook token of <network>, or None
+    when the network has no token"""
+    # getSpecific() falls back to the global value for networks the bot is
+    # not connected to, whose webhooks are spooled.
+    expected = conf.supybot.plugins.Gitlab.webhook.token.get(':' + network)()
+    if not expected:
+        return None
+    return token is not None and hmac.compare_digest(
+        expected.encode('utf-8'), token.encode('utf-8'))
+
+
+# Settings of a subscribed project that restrict the events announced
+FILTER_RULES = ('events', 'actions', 'refs', 'authors', 'exclude-authors')
+
+
+def _ref_name(ref):
+    for prefix in ('refs/heads/', 'refs/tags/'):
+        if ref.startswith(prefix):
+            return ref[len(prefix):]
+    return ref
+
+
+def filter_fields(payload):
+    """Returns the action, the branch or tag, and the lowercased names of
+    the author of an event, as matched by EventFilter"""
+    attributes = payload.get('object_attributes')
+    if not isinstance(attributes, dict):
+        attributes = {}
+    ref = payload.get('ref') or attributes.get('ref') or \
+        attributes.get('target_branch')
+    authors = set()
+    user = payload.get('user')
+    if not isinstance(user, dict):
+        user = {}
+    for name in (payload.get('user_username'), payload.get('user_name'),
+                 user.get('username'), user.get('name')):
+        if name:
+            authors.add(name.lower())
+    return (attributes.get('action'), ref and _ref_name(ref),
+            frozenset(authors))
+
+
+class EventFilter(object):
+
+    """Matches the events announced for a subscription against the rules
+    of its settings; an event lacking the matched field is announced"""
+
+    __slots__ = ('events', 'actions', 'refs', 'authors', 'exclude_authors')
+
+    def __init__(self, settings):
+        self.events = frozenset(settings.get('events', ())) or None
+        self.actions = frozenset(settings.get('actions', ())) or None
+        refs = settings.get('refs')
+        # All the globs are matched at once.
+        self.refs = refs and re.compile('|'.join(
+            '(?:%s)' % fnmatch.translate(ref) for ref in refs)).match
+        self.authors = frozenset(author.lower() for author
+                                 in settings.get('authors', ())) or None
+        self.exclude_authors = frozenset(
+            author.lower() for author
+            in settings.get('exclude-authors', ())) or None
+
+    @classmethod
+    def compile(cls, settings):
+        """Returns the filter of <settings>, or None if they have no rule"""
+        for rule in FILTER_RULES:
+            if settings.get(rule):
+                return cls(settings)
+        return None
+
+    def matches(self, kind, fields):
+        action, ref, authors = fields
+        if self.events is not None and kind not in self.events:
+            return False
+        if self.actions is not None and action is not None and \
+                action not in self.actions:
+            return False
+        if self.refs and ref is not None and not self.refs(ref):
+            return False
+        if self.authors is not None and authors and \
+                self.authors.isdisjoint(authors):
+            return False
+        if self.exclude_authors is not None and \
+                not self.exclude_authors.isdisjoint(authors):
+            return False
+        return True
+
+
+class Subscription(object):
+
+    """A project announced to a channel"""
+
+    __slots__ = ('channel', 'slug', 'url', 'host', 'project_id', 'path',
+                 'token', 'filter')
+
+    def __init__(self, channel, slug, settings):
+        self.channel = channel
+        self.slug = slug
+        self.url = settings['url']
+        # Project ids and paths are unique to a Gitlab instance.
+        self.host = project_host(self.url)
+        # Learned from the first event carrying a secret token, unless given
+        self.project_id = settings.get('id')
+        self.path = settings.get('path')
+        self.token = settings.get('token')
+        self.filter = EventFilter.compile(settings)
+
+    def accepts(self, token):
+        """Returns whether a webhook sent with <token> may be announced"""
+        if not self.token:
+            return True
+        return token is not None and \
+            hmac.compare_digest(self.token.encode('utf-8'),
+                                token.encode('utf-8'))
+
+
+class ProjectIndex(object):
+
+    """Maps projects to the channels subscribed to them.
+
+    Subscriptions whose project id is known are found by the host of their
+    Gitlab instance and this id only, so that they survive renames; the
+    others by their normalized url or their path_with_namespace."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Mappings of keys to tuples of Subscriptions
+        self._ids = {}
+        self._paths = {}
+        self._routes = {}
+        # channel -> [(mapping, key, subscription)]
+        self._channels = {}
+        # Digests of the project tokens, with the number of projects using
+        # them
+        self._tokens = {}
+
+    def _keys(self, subscription):
+        if subscription.project_id is not None:
+            yield self._ids, (subscription.host, subscription.project_id)
+            return
+        yield self._routes, normalize_project_url(subscription.url)
+        if subscription.path:
+            yield self._paths, (subscription.host, subscription.path.lower())
+
+    def update(self, channel, projects):
+        """Replaces the subscriptions of <channel> by <projects>"""
+        with self._lock:
+            self._remove(channel)
+            subscriptions = []
+            for slug, entry in projects.items():
+                subscription = Subscription(channel, slug,
+                                            project_settings(entry))
+                for mapping, key in self._keys(subscription):
+                    # Tuples are replaced instead of mutated so that lookup()
+                    # does not need the lock.
+                    mapping[key] = mapping.get(key, ()) + (subscription,)
+                    subscriptions.append((mapping, key, subscription))
+                if subscription.token:
+                    digest = token_digest(subscription.token)
+                    self._tokens[digest] = self._tokens.get(digest, 0) + 1
+            if subscriptions:
+                self._channels[channel] = subscriptions
+
+    def remove(self, channel):
+        with self._lock:
+            self._remove(channel)
+
+    def clear(self):
+        with self._lock:
+            self._ids = {}
+            self._paths = {}
+            self._routes = {}
+            self._channels = {}
+            self._tokens = {}
+
+    def _remove(self, channel):
+        removed = set()
+        for mapping, key, subscription in self._channels.pop(channel, ()):
+            routes = tuple(route for route in mapping.get(key, ())
+                           if route is not subscription)
+            if routes:
+                mapping[key] = routes
+            else:
+                mapping.pop(key, None)
+            if subscription.token and id(subscription) not in removed:
+                removed.add(id(subscription))
+                digest = token_digest(subscription.token)
+                self._tokens[digest] -= 1
+                if not self._tokens[digest]:
+                    del self._tokens[digest]
+
+    def lookup(self, url, project_id=None, path=None):
+        """Returns a tuple of the Subscriptions to the project of an event,
+        given its <url>, and its id and path_with_namespace if known"""
+        key = normalize_project_url(url)
+        routes = self._routes.get(key, ())
+        host = key.split('/', 1)[0]
+        if path:
+            by_path = self._paths.get((host, path.lower()))
+            if by_path:
+                routes += tuple(route for route in by_path
+                                if route not in routes)
+        if project_id is not None:
+            routes = self._ids.get((host, project_id), ()) + routes
+        return routes
+
+    def has_tokens(self):
+        return bool(self._tokens)
+
+    def knows_token(self, token):
+        """Returns whether a subscribed project uses <token>"""
+        # Looking up a digest does not leak how much of a token matches.
+        return token_digest(token) in self._tokens
+
+
+class Template(object):
+
+    """A format string, which renders like str.format(**args)"""
+
+    def __init__(self, format_string):
+        self.format_string = format_string
+        # format_map() skips building a keyword dict on every call.
+        self.format = format_string.format_map
+
+
+class ChannelValueCache(object):
+
+    """Caches channel-specific values of a registry group until they are
+    changed, optionally transformed by <transform>"""
+
+    def __init__(self, group, transform=None):
+        self._group = group
+        self._transform = transform
+        self._lock = threading.RLock()
+        self._cache = {}
+        self._watched = {}
+        # removeCallback() compares callbacks by identity, and every access
+        # to a method creates a new bound method.
+        self._callback = self._invalidate
+        # Incremented whenever a cached value changes
+        self.generation = 0
+
+    def get(self, name, channel):
+        key = (name, channel)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        with self._lock:
+            value = self._group
+            for part in name.split('.'):
+                value = value.get(part)
+            value = value.getSpecific(channel=channel)
+            if key not in self._watched:
+                value.addCallback(self._callback, key)
+                self._watched[key] = value
+            result = value()
+            if self._transform is not None:
+                result = self._transform(result)
+            self._cache[key] = result
+            return result
+
+    def _invalidate(self, key):
+        with self._lock:
+            self._cache.pop(key, None)
+            self.generation += 1
+
+    def close(self):
+        with self._lock:
+            for value in self._watched.values():
+                value.removeCallback(self._callback)
+            self._watched = {}
+            self._cache = {}
+
+
+class Debouncer(object):
+
+    """Collapses announcements with the same key made within a time window
+    into a single one, sent when the window of the first one ends.
+
+    Pending announcements are grouped by deadline into ticks of <resolution>
+    seconds, with one scheduled event per tick instead of one per key."""
+
+    def __init__(self, send, resolution=1):
+        self._send = send
+        self._resolution = resolution
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._ticks = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, key, target, msg, window):
+        """Schedules <msg>, passed to the send function with <target> and
+        the number of collapsed announcements"""
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is not None:
+                # Announce the latest state of the object once the window ends
+                entry[1] = msg
+                entry[2] += 1
+                return
+            tick = int(math.ceil((time.time() + window) / self._resolution))
+            self._pending[key] = [target, msg, 1, tick]
+            if tick in self._ticks:
+                self._ticks[tick][1].append(key)
+            else:
+                name = schedule.addEvent(
+                    functools.partial(self._flush_tick, tick),
+                    tick * self._resolution)
+                self._ticks[tick] = (name, [key])
+
+    def _flush_tick(self, tick):
+        with self._lock:
+            name, keys = self._ticks.pop(tick, (None, ()))
+            entries = [self._pending.pop(key) for key in keys]
+        for target, msg, count, tick in entries:
+            self._send(target, msg, count)
+
+    def send_now(self, keys):
+        """Sends the pending announcements of <keys> now, in order"""
+        entries = []
+        with self._lock:
+            for key in keys:
+                entry = self._pending.pop(key, None)
+                if entry is None:
+                    continue
+                name, tick_keys = self._ticks[entry[3]]
+                tick_keys.remove(key)
+                if not tick_keys:
+                    del self._ticks[entry[3]]
+                    try:
+                        schedule.removeEvent(name)
+                    except KeyError:
+                        pass
+                entries.append(entry)
+        for target, msg, count, tick in entries:
+            self._send(target, msg, count)
+
+    def flush(self):
+        """Sends every pending announcement now"""
+        with self._lock:
+            ticks = sorted(self._ticks.items())
+            self._ticks = {}
+            entries = [self._pending.pop(key)
+                       for tick, (name, keys) in ticks for key in keys]
+        for tick, (name, keys) in ticks:
+            try:
+                schedule.removeEvent(name)
+            except KeyError:
+                pass
+        for target, msg, count, tick in entries:
+            self._send(target, msg, count)
+
+
+class TopCounter(object):
+
+    """Approximate counts of the most frequent keys, kept in at most <size>
+    slots: a new key seen while they are full takes the slot of the least
+    frequent one, and its count (the Space-Saving algorithm)"""
+
+    __slots__ = ('_size', '_counts')
+
+    def __init__(self, size):
+        self._size = size
+        self._counts = {}
+
+    def add(self, key, count=1):
+        counts = self._counts
+        if key in counts:
+            counts[key] += count
+        elif len(counts) < self._size:
+            counts[key] = count
+        else:
+            least = min(counts, key=counts.get)
+            counts[key] = counts.pop(least) + count
+
+    def most_common(self, n):
+        return sorted(self._counts.items(),
+                      key=lambda item: (-item[1], item[0]))[:n]
+
+
+# Counters of a digest, with the item and the adjective naming them
+DIGEST_COUNTERS = (
+    ('pushes', 'push', None),
+    ('commits', 'commit', None),
+    ('tags', 'tag', None),
+    ('merge_requests_opened', 'merge request', 'opened'),
+    ('merge_requests_merged', 'merge request', 'merged'),
+    ('issues_opened', 'issue', 'opened'),
+    ('issues_closed', 'issue', 'closed'),
+    ('comments', 'comment', None),
+    ('pipelines_failed', 'pipeline', 'failed'),
+    ('jobs_failed', 'job', 'failed'),
+    ('other', 'other event', None),
+)
+
+# Counters of the actions of issues and merge requests
+DIGEST_ACTIONS = {
+    ('merge-request', 'open'): 'merge_requests_opened',
+    ('merge-request', 'merge'): 'merge_requests_merged',
+    ('issue', 'open'): 'issues_opened',
+    ('issue', 'close'): 'issues_closed',
+}
+
+
+class ProjectDigest(object):
+
+    """Counters of the events of a project since the last digest"""
+
+    __slots__ = ('project', 'counts', 'authors')
+
+    def __init__(self, project, authors):
+        self.project = project
+        self.counts = dict.fromkeys(
+            (name for name, item, adjective in DIGEST_COUNTERS), 0)
+        # Twice as many slots as the listed authors keeps them accurate.
+        self.authors = TopCounter(2 * authors)
+
+    def add(self, counts, author):
+        for name, count in counts.items():
+            self.counts[name] += count
+        if author:
+            self.authors.add(author)
+
+    def summary(self):
+        return ', '.join(utils.str.nItems(self.counts[name], item, adjective)
+                         for name, item, adjective in DIGEST_COUNTERS
+                         if self.counts[name])
+
+
+class Digest(object):
+
+    """Counts the events announced to channels in digest mode and passes
+    their counters to the send function when the interval of the first one
+    ends.
+
+    At most <projects> projects are counted per channel, the events of the
+    others are only added up, so that memory does not grow with the number
+    of events."""
+
+    def __init__(self, send):
+        self._send = send
+        self._lock = threading.Lock()
+        # key -> [target, OrderedDict of ProjectDigests by slug, number of
+        # events of the other projects, name of the scheduled event]
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, key, target, project, counts, author, interval, projects,
+            authors):
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is None:
+                name = schedule.addEvent(functools.partial(self._flush, key),
+                                         time.time() + interval)
+                entry = self._pending[key] = [target,
+                                              collections.OrderedDict(), 0,
+                                              name]
+            digest = entry[1].get(project['name'])
+            if digest is None:
+                if len(entry[1]) >= projects:
+                    entry[2] += 1
+                    return
+                digest = entry[1][project['name']] = \
+                    ProjectDigest(project, authors)
+            digest.add(counts, author)
+
+    def _flush(self, key):
+        with self._lock:
+            entry = self._pending.pop(key, None)
+        if entry is not None:
+            target, digests, more, name = entry
+            self._send(target, list(digests.values()), more)
+
+    def flush(self):
+        """Sends every pending digest now"""
+        with self._lock:
+            entries = list(self._pending.items())
+        for key, (target, digests, more, name) in entries:
+            try:
+                schedule.removeEvent(name)
+            except KeyError:
+                pass
+            self._flush(key)
+
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+METRICS = [
+    ('gitlab_webhooks_total', 'counter',
+     'Webhooks received, by event type.', None),
+    ('gitlab_errors_total', 'counter',
+     'Webhooks that could not be handled, by kind of error.', None),
+    ('gitlab_duplicates_total', 'counter',
+     'Webhooks ignored because they were already delivered.', None),
+    ('gitlab_filtered_total', 'counter',
+     'Events not announced to a channel because of its filters, by event '
+     'type.', None),
+    ('gitlab_parse_seconds', 'histogram',
+     'Time spent decoding webhook bodies.', LATENCY_BUCKETS),
+    ('gitlab_routing_seconds', 'histogram',
+     'Time spent resolving the channels an event is announced to.',
+     LATENCY_BUCKETS),
+    ('gitlab_format_seconds', 'histogram',
+     'Time spent rendering a message.', LATENCY_BUCKETS),
+    ('gitlab_messages_per_event', 'histogram',
+     'IRC messages queued for an event.', COUNT_BUCKETS),
+]
+
+
+class Histogram(object):
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels)
+
+
+class Metrics(object):
+
+    """In-process counters and histograms, rendered in the Prometheus text
+    exposition format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = collections.OrderedDict()
+        self._collectors = []
+        for name, type, help, buckets in METRICS:
+            self._metrics[name] = (type, help, buckets, {})
+
+    def add_collector(self, collector):
+        """Adds a callable returning (name, type, help, labels, value)
+        tuples of values computed when the metrics are rendered"""
+        self._collectors.append(collector)
+
+    def inc(self, name, labels=(), value=1):
+        values = self._metrics[name][3]
+        with self._lock:
+            values[labels] = values.get(labels, 0) + value
+
+    def observe(self, name, value, labels=()):
+        type, help, buckets, values = self._metrics[name]
+        with self._lock:
+            histogram = values.get(labels)
+            if histogram is None:
+                histogram = values[labels] = Histogram(buckets)
+            histogram.observe(value)
+
+    def counter(self, name):
+        """Returns the values of a counter by labels"""
+        with self._lock:
+            return dict(self._metrics[name][3])
+
+    def histogram(self, name):
+        """Returns the (count, sum) of a histogram, summed over labels"""
+        with self._lock:
+            histograms = self._metrics[name][3].values()
+            return (sum(h.count for h in histograms),
+                    sum(h.sum for h in histograms))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (type, help, buckets, values) in self._metrics.items():
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, type))
+                for labels, value in sorted(values.items()):
+                    if type != 'histogram':
+                        lines.append('%s%s %s' % (
+                            name, _format_labels(labels), value))
+                        continue
+                    cumulative = 0
+                    bounds = [repr(float(b)) for b in buckets] + ['+Inf']
+                    for bound, count in zip(bounds, value.counts):
+                        cumulative += count
+                        lines.append('%s_bucket%s %d' % (
+                            name, _format_labels(labels + (('le', bound),)),
+                            cumulative))
+                    lines.append('%s_sum%s %r' % (
+                        name, _format_labels(labels), value.sum))
+                    lines.append('%s_count%s %d' % (
+                        name, _format_labels(labels), value.count))
+        described = set()
+        for collector in self._collectors:
+            for name, type, help, labels, value in collector():
+                if name not in described:
+                    lines.append('# HELP %s %s' % (name, help))
+                    lines.append('# TYPE %s %s' % (name, type))
+                    described.add(name)
+                lines.append('%s%s %s' % (name, _format_labels(labels),
+                                          value))
+        return '\n'.join(lines) + '\n'
+
+
+class EventType(object):
+
+    """Describes how a X-Gitlab-Event is routed and announced: <project_url>
+    and <project_id> extract the project from a payload and <handler> names
+    the GitlabHandler method announcing it to a channel"""
+
+    def __init__(self, name, project_url, project_id, handler, prepare=None):
+        self.name = name
+        self.project_url = project_url
+        self.project_id = project_id
+        self.handler = handler
+        # Name of the event in the filters of the subscriptions, e.g.
+        # 'merge-request' for 'Merge Request Hook'
+        kind = name[:-len(' Hook')] if name.endswith(' Hook') else name
+        self.kind = kind.lower().replace(' ', '-')
+        # GitlabHandler method called once per event before it is announced,
+        # with its project id, its payload and the network it was sent for
+        # (None for every network), returning the fields derived from the
+        # payload that are shared by every channel
+        self.prepare = prepare
+        # Number of received events and of channels they were routed to
+        self.received = 0
+        self.routed = 0
+
+
+def _repository_url(payload):
+    return payload['repository']['homepage']
+
+
+def _issue_url(payload):
+    return _strip_object_path(payload['object_attributes']['url'])
+
+
+def _project_path(payload):
+    project = payload.get('project')
+    if isinstance(project, dict):
+        return project.get('path_with_namespace')
+    return None
+
+
+def _pipeline_url(payload):
+    return payload['project']['web_url']
+
+
+def _merge_request_url(payload):
+    target = payload['object_attributes']['target']
+    return target.get('web_url') or target['http_url']
+
+
+def default_event_types():
+    return [
+        EventType('Push Hook', _repository_url,
+                  operator.itemgetter('project_id'), '_push_hook',
+                  '_prepare_push'),
+        EventType('Tag Push Hook', _repository_url,
+                  operator.itemgetter('project_id'), '_tag_push_hook',
+                  '_prepare_push'),
+        EventType('Note Hook', _repository_url,
+                  operator.itemgetter('project_id'), '_note_hook',
+                  '_prepare_note'),
+        EventType('Issue Hook', _issue_url,
+                  lambda payload: payload['object_attributes']['project_id'],
+                  '_issue_hook', '_prepare_issue'),
+        EventType('Merge Request Hook', _merge_request_url,
+                  lambda payload:
+                      payload['object_attributes']['target_project_id'],
+                  '_merge_request_hook', '_prepare_merge_request'),
+        EventType('Pipeline Hook', _pipeline_url,
+                  lambda payload: payload['project']['id'],
+                  '_pipeline_hook', '_prepare_pipeline'),
+        EventType('Job Hook', _repository_url,
+                  operator.itemgetter('project_id'), '_job_hook',
+                  '_prepare_job'),
+    ]
+
+
+class StatusHistory(object):
+
+    """Remembers the last finished status of the most recently used keys"""
+
+    def __init__(self, size):
+        self._size = size
+        self._lock = threading.Lock()
+        self._statuses = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._statuses)
+
+    def update(self, key, status):
+        """Stores <status> and returns the previous status of <key>"""
+        with self._lock:
+            previous = self._statuses.pop(key, None)
+            self._statuses[key] = status
+            if len(self._statuses) > self._size:
+                self._statuses.popitem(last=False)
+            return previous
+
+
+class DedupeCache(object):
+
+    """Remembers keys for a while, keeping at most <size> of them"""
+
+    def __init__(self, size):
+        self._size = size
+        self._lock = threading.Lock()
+        self._expiries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._expiries)
+
+    def seen(self, key, ttl):
+        """Returns whether <key> was seen in the last <ttl> seconds and
+        remembers it"""
+        now = time.time()
+        with self._lock:
+            # Keys are inserted in expiry order, so expired ones come first.
+            while self._expiries:
+                oldest, expiry = next(iter(self._expiries.items()))
+                if expiry > now:
+                    break
+                del self._expiries[oldest]
+            if key in self._expiries:
+                return True
+            self._expiries[key] = now + ttl
+            if len(self._expiries) > self._size:
+                self._expiries.popitem(last=False)
+            return False
+
+    def forget(self, key):
+        """Forgets <key>, if it was remembered"""
+        with self._lock:
+            self._expiries.pop(key, None)
+
+    def copy(self):
+        """Returns a DedupeCache remembering the same keys"""
+        cache = DedupeCache(self._size)
+        with self._lock:
+            cache._expiries = collections.OrderedDict(self._expiries)
+        return cache
+
+
+def delivery_key(headers, payload):
+    """Returns a key identifying a webhook across retries, or None"""
+    for header in ('Idempotency-Key', 'X-Gitlab-Event-UUID'):
+        if headers.get(header):
+            return headers[header]
+    event = headers['X-Gitlab-Event']
+    if 'after' in payload:
+        # Pushes are identified by the ref update
+        return (event, payload.get('project_id'),
+                payload.get('repository', {}).get('homepage'),
+                payload.get('ref'), payload.get('before'), payload['after'])
+    if 'build_id' in payload:
+        return (event, payload['build_id'], payload.get('build_status'))
+    attributes = payload.get('object_attributes')
+    if isinstance(attributes, dict) and 'id' in attributes:
+        return (event, attributes['id'], attributes.get('updated_at'),
+                attributes.get('action'), attributes.get('status'),
+                attributes.get('finished_at'))
+    return None
+
+
+# Formats with a variant using the data read from the API, named after them
+# with an -enriched suffix
+ENRICHED_FORMATS = ('push', 'merge-request-open', 'merge-request-update')
+
+# Channel settings that change what is announced to a channel
+RENDER_SETTINGS = ('use-notices', 'commits.max', 'commits.coalesce',
+                   'coalesce.window', 'coalesce.actions', 'pipelines.announce',
+                   'jobs.announce', 'digest.interval')
+
+
+def max_targets(irc, command):
+    """Returns how many channels a <command> sent to <irc> may target, None
+    meaning no limit"""
+    targmax = irc.state.supported.get('targmax')
+    if targmax:
+        for limit in targmax.split(','):
+            name, _sep, value = limit.partition(':')
+            if name.upper() == command:
+                return int(value) if value else None
+        return 1
+    return irc.state.supported.get('maxtargets') or 1
+
+
+def split_targets(irc, command, channels, msg):
+    """Splits <channels> into comma-separated lists of targets such that
+    <command> fits in one line with each of them"""
+    limit = max_targets(irc, command)
+    # Leave room for the bot's hostmask, like GitlabHandler._coalesce().
+    room = 512 - len('%s  :\r\n' % command) - len(msg.encode('utf-8')) - 100
+    targets = []
+    current = []
+    length = -1
+    for channel in channels:
+        size = len(channel.encode('utf-8')) + 1
+        if current and (len(current) == limit or length + size > room):
+            targets.append(','.join(current))
+            current = []
+            length = -1
+        current.append(channel)
+        length += size
+    if current:
+        targets.append(','.join(current))
+    return targets
+
+
+class Announcement(object):
+
+    """The networks and the channels an event is announced to, passed to the
+    hooks of GitlabHandler instead of being stored on it so that events are
+    handled concurrently"""
+
+    __slots__ = ('ircs', 'channels', 'queued')
+
+    def __init__(self, ircs, channels):
+        self.ircs = ircs
+        self.channels = channels
+        # Number of messages queued for the event
+        self.queued = 0
+
+    @property
+    def channel(self):
+        """The channel whose settings and templates are used; the others
+        are configured alike"""
+        return self.channels[0]
+
+
 class GitlabHandler(object):
 
     """Handle gitlab messages"""
@@ -58,101 +969,333 @@ class GitlabHandler(object):
     def __init__(self, plugin):
         self.plugin = plugin
         self.log = log.getPluginLogger('Gitlab')
-        # HACK: instead of refactoring everything, I can just replace this with each handle_payload() call.
-        self.irc = None
-
-    def handle_payload(self, headers, payload, irc):
+        # Guards the counters and the profiles, shared by the threads
+        # handling webhooks
+        self._lock = threading.Lock()
+        # OutboundScheduler sending the messages, if enabled
+        self.outbound = None
+        # api.Client reading what webhooks do not contain, if enabled
+        self.api = None
+        # Identifiers of the settings and templates of the channels, so that
+        # channels configured alike share the messages rendered for them
+        self._profiles = {}
+        self._profile_ids = {}
+        # Generations of the caches the profiles were computed with, and the
+        # next identifier, which is never reused
+        self._profile_generation = None
+        self._next_profile_id = 0
+        self.debouncer = Debouncer(self._send_debounced)
+        self.digest = Digest(self._send_digest)
+        # Number of messages queued since the handler was created
+        self.queued = 0
+        self.metrics = plugin._metrics
+        self.deliveries = DedupeCache(plugin.registryValue('dedupe.size'))
+        self.statuses = StatusHistory(
+            plugin.registryValue('pipelines.history'))
+        self.event_types = {}
+        for event_type in default_event_types():
+            self.register_event_type(event_type)
+
+    def register_event_type(self, event_type):
+        """Adds (or replaces) the handling of an X-Gitlab-Event"""
+        self.event_types[event_type.name] = event_type
+
+    def handle_payload(self, headers, payload, irc=None):
+        """Announces <payload> on <irc>, or on every network when <irc> is
+        None"""
+        metrics = self.metrics
         if 'X-Gitlab-Event' not in headers:
             self.log.info('Invalid header: Missing X-Gitlab-Event entry')
+            metrics.inc('gitlab_errors_total', (('kind', 'missing_event'),))
             return
-        self.irc = irc
-        self.log.debug('GitLab: running on network %r', irc.network)
-
-        event_type = headers['X-Gitlab-Event']
-        if event_type not in ['Push Hook', 'Tag Push Hook', 'Note Hook', 'Issue Hook', 'Merge Request Hook']:
+        token = headers.get('X-Gitlab-Token')
+        if irc is None:
+            # Each network only gets the webhooks that carry its token
+            matches = [(irc, network_token_matches(irc.network, token))
+                       for irc in world.ircs if not irc.zombie]
+            ircs = [irc for irc, match in matches if match is not False]
+            verified = bool(ircs) and all(match for irc, match in matches)
+            self.log.debug('GitLab: running on all networks')
+        else:
+            ircs = [irc]
+            verified = network_token_matches(irc.network, token)
+            if verified is False:
+                # Also checked for the webhooks spooled for the network
+                self.log.info('Invalid token for network %r', irc.network)
+                metrics.inc('gitlab_errors_total',
+                            (('kind', 'invalid_token'),))
+                return
+            verified = verified is True
+            self.log.debug('GitLab: running on network %r', irc.network)
+
+        event_type = self.event_types.get(headers['X-Gitlab-Event'])
+        if event_type is None:
             self.log.info('Unsupported X-Gitlab-Event type')
+            metrics.inc('gitlab_webhooks_total', (('event', 'unsupported'),))
             return
-
-        # Check if any channel has subscribed to this project
-        for channel in irc.state.channels.keys():
-            projects = self.plugin._load_projects(channel)
-            for slug, url in projects.items():
-                # Parse project url
-                if event_type == 'Push Hook' or event_type == 'Tag Push Hook' or event_type == 'Note Hook':
-                    if url != payload['repository']['homepage']:
-                        continue
-                elif event_type == 'Issue Hook':
-                    if url not in payload['object_attributes']['url']:
-                        continue
-                elif event_type == 'Merge Request Hook':
-                    if url not in payload['object_attributes']['target']['http_url']:
-                        continue
-                else:
+        with self._lock:
+            event_type.received += 1
+        metrics.inc('gitlab_webhooks_total', (('event', event_type.name),))
+
+        delivery = None
+        ttl = self.plugin.registryValue('dedupe.ttl')
+        if ttl:
+            key = delivery_key(headers, payload)
+            if key is not None:
+                delivery = (irc.network if irc else None, key)
+                if self.deliveries.seen(delivery, ttl):
+                    self.log.info('Ignoring duplicate delivery of %s',
+                                  event_type.name)
+                    metrics.inc('gitlab_duplicates_total')
+                    return
+        # The delivery is only remembered once a subscription accepted it
+        # and it was announced, so that GitLab's retries of a failed or
+        # rejected delivery go through.
+        try:
+            accepted = self._route(headers, payload, ircs, event_type,
+                                   verified, irc.network if irc else None)
+        except Exception:
+            if delivery is not None:
+                self.deliveries.forget(delivery)
+            raise
+        if not accepted and delivery is not None:
+            self.deliveries.forget(delivery)
+
+    def _route(self, headers, payload, ircs, event_type, verified=False,
+               network=None):
+        """Announces <payload> in the channels subscribed to its project on
+        <ircs>, and returns whether any subscription accepted its token.
+        <verified> tells whether it carried the webhook token of the
+        networks, and <network> names the network it was sent for, if
+        any."""
+        metrics = self.metrics
+        handle = getattr(self, event_type.handler)
+
+        # Resolve the channels that subscribed to this project
+        start = time.perf_counter()
+        project_url = event_type.project_url(payload)
+        try:
+            project_id = event_type.project_id(payload)
+        except (KeyError, TypeError):
+            project_id = None
+        project_path = _project_path(payload)
+        token = headers.get('X-Gitlab-Token')
+        targets = []
+        fields = None
+        accepted = False
+        for subscription in self.plugin._index.lookup(
+                project_url, project_id, project_path):
+            if not subscription.accepts(token):
+                continue
+            accepted = True
+            # Once learned, the id is the only route to the project: it is
+            # only taken from webhooks that carried a secret token, as
+            # anyone may send any id and path.
+            if subscription.project_id is None and project_id is not None \
+                    and (verified or subscription.token):
+                self._learn_project(subscription, project_id, project_path)
+            if subscription.filter is not None:
+                if fields is None:
+                    fields = filter_fields(payload)
+                if not subscription.filter.matches(event_type.kind, fields):
+                    metrics.inc('gitlab_filtered_total',
+                                (('event', event_type.name),))
                     continue
-
-                # Update payload
-                payload['project'] = {
-                    'name': slug,
-                    'url': url
-                }
-
-                if event_type == 'Issue Hook':
-                    payload['project']['id'] = payload[
-                        'object_attributes']['project_id']
-                elif event_type == 'Merge Request Hook':
-                    payload['project']['id'] = payload[
-                        'object_attributes']['target_project_id']
-                else:
-                    payload['project']['id'] = payload['project_id']
-
-                # Handle types
-                if event_type == 'Push Hook':
-                    self._push_hook(channel, payload)
-                elif event_type == 'Tag Push Hook':
-                    self._tag_push_hook(channel, payload)
-                elif event_type == 'Issue Hook':
-                    self._issue_hook(channel, payload)
-                elif event_type == 'Note Hook':
-                    self._note_hook(channel, payload)
-                elif event_type == 'Merge Request Hook':
-                    self._merge_request_hook(channel, payload)
-
-    def _push_hook(self, channel, payload):
+            # Channels with the same name share the messages rendered for
+            # them across networks.
+            joined = tuple(irc for irc in ircs
+                           if subscription.channel in irc.state.channels)
+            if joined:
+                targets.append((subscription, joined))
+        metrics.observe('gitlab_routing_seconds',
+                        time.perf_counter() - start)
+
+        # Channels announcing the same project with the same settings on the
+        # same networks get the same messages.
+        groups = collections.OrderedDict()
+        # Groups whose webhook carried a secret token
+        trusted = set()
+        for subscription, joined in targets:
+            key = (subscription.slug, subscription.url,
+                   subscription.project_id, joined,
+                   self._profile(subscription.channel))
+            groups.setdefault(key, []).append(subscription.channel)
+            if verified or subscription.token:
+                trusted.add(key)
+
+        queued = 0
+        event = None
+        enrichments = {}
+        for group, channels in groups.items():
+            slug, url, known_id, joined, profile = group
+            context = Announcement(joined, tuple(channels))
+            if event is None:
+                # The payload is left untouched: the fields derived from it
+                # are computed once and layered on top of it.
+                derived = {}
+                if event_type.prepare is not None:
+                    derived = getattr(self, event_type.prepare)(
+                        project_id, payload, network)
+                event = collections.ChainMap(derived, payload)
+
+            fields = {'project': {
+                'name': slug,
+                'url': url,
+                'id': project_id
+            }}
+            interval = self.plugin._settings.get('digest.interval',
+                                                 context.channel)
+            # Anyone may send any project id: the API is only read for the
+            # id of the payload when it carried a secret token.
+            if not interval and (known_id is not None or group in trusted):
+                resource = self._api_resource(event_type.kind, payload,
+                                              context.channel)
+                if resource is not None:
+                    # Read from the subscribed instance, which is trusted
+                    # with the token of the API, unlike the payload.
+                    key = (url, known_id, resource)
+                    if key not in enrichments:
+                        enrichments[key] = self._api_get(
+                            url, project_path,
+                            project_id if known_id is None else known_id,
+                            resource)
+                    if enrichments[key] is not None:
+                        fields['api'] = enrichments[key]
+            view = event.new_child(fields)
+
+            if interval:
+                self._add_to_digest(context, event_type.kind, view, interval)
+            else:
+                handle(context, view)
+            queued += context.queued
+        with self._lock:
+            event_type.routed += sum(len(channels)
+                                     for channels in groups.values())
+            self.queued += queued
+        metrics.observe('gitlab_messages_per_event', queued)
+        return accepted
+
+    def _learn_project(self, subscription, project_id, path):
+        self.plugin._learn_project(subscription, project_id, path)
+
+    def _profile(self, channel):
+        """Returns an identifier of the templates and settings of
+        <channel>"""
+        generation = (self.plugin._templates.generation,
+                      self.plugin._settings.generation)
+        cached = self._profiles.get(channel)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        formats = conf.supybot.plugins.Gitlab.format
+        profile = tuple(
+            self.plugin._templates.get('format.' + name, channel).format_string
+            for name, value in formats.getValues(fullNames=False))
+        for name in RENDER_SETTINGS:
+            value = self.plugin._settings.get(name, channel)
+            profile += (tuple(value) if isinstance(value, list) else value,)
+        with self._lock:
+            if generation != self._profile_generation:
+                # The profiles of the previous values are not used anymore.
+                self._profile_generation = generation
+                self._profiles = {}
+                self._profile_ids = {}
+            profile_id = self._profile_ids.get(profile)
+            if profile_id is None:
+                profile_id = self._profile_ids[profile] = \
+                    self._next_profile_id
+                self._next_profile_id += 1
+            self._profiles[channel] = (generation, profile_id)
+        return profile_id
+
+    def _push_hook(self, context, payload):
         # Send general message
-        msg = self._build_message(channel, 'push', payload)
-        self._send_message(channel, msg)
-
-        # Send commits
-        for commit in payload['commits']:
-            commit['project'] = {
-                'id': payload['project_id'],
-                'name': payload['project']['name'],
-                'url': payload['project']['url']
-            }
-            commit['short_message'] = commit['message'].splitlines()[0]
-            commit['short_id'] = commit['id'][0:10]
-
-            msg = self._build_message(channel, 'commit', commit)
-            self._send_message(channel, msg)
-
-    def _tag_push_hook(self, channel, payload):
-        msg = self._build_message(channel, 'tag', payload)
-        self._send_message(channel, msg)
-
-        # Send commits
-        for commit in payload['commits']:
-            commit['project'] = {
-                'id': payload['project_id'],
-                'name': payload['project']['name'],
-                'url': payload['project']['url']
-            }
-            commit['short_message'] = commit['message'].splitlines()[0]
-            commit['short_id'] = commit['id'][0:10]
-
-            msg = self._build_message(channel, 'commit', commit)
-            self._send_message(channel, msg)
-
-    def _note_hook(self, channel, payload):
+        msg = self._build_message(context.channel, 'push', payload)
+        self._announce(context, msg, 'push')
+
+        self._send_commits(context, payload)
+
+    def _tag_push_hook(self, context, payload):
+        msg = self._build_message(context.channel, 'tag', payload)
+        self._announce(context, msg, 'tag')
+
+        self._send_commits(context, payload)
+
+    def _prepare_push(self, project_id, payload, network):
+        # GitLab sends at most 20 commits per push.
+        commits = [collections.ChainMap({
+            'short_message': commit['message'].splitlines()[0],
+            'short_id': commit['id'][0:10],
+        }, commit) for commit in payload['commits']]
+        return {
+            'commits': commits,
+            'compare_url': self._compare_url(payload),
+        }
+
+    def _send_commits(self, context, payload):
+        channel = context.channel
+        commits = payload['commits']
+        limit = self.plugin._settings.get('commits.max', channel)
+        if limit:
+            commits = commits[:limit]
+
+        project = {'project': {
+            'id': payload['project_id'],
+            'name': payload['project']['name'],
+            'url': payload['project']['url']
+        }}
+        msgs = []
+        for commit in commits:
+            msgs.append(self._build_message(channel, 'commit',
+                                            commit.new_child(project)))
+
+        if self.plugin._settings.get('commits.coalesce', channel):
+            msgs = self._coalesce(max(context.channels, key=len), msgs)
+        for msg in msgs:
+            self._announce(context, msg, 'commit')
+
+        # GitLab only includes the first commits of large pushes
+        total = payload.get('total_commits_count', len(payload['commits']))
+        if total > len(commits):
+            args = payload.new_child({'count': total - len(commits)})
+            msg = self._build_message(channel, 'commits-more', args)
+            self._announce(context, msg, 'commits-more')
+
+    def _compare_url(self, payload):
+        homepage = payload['repository']['homepage']
+        before = payload.get('before', '').strip('0')
+        if before:
+            return '%s/compare/%s...%s' % (homepage, payload['before'],
+                                           payload['after'])
+        return '%s/commits/%s' % (homepage, payload.get('after', ''))
+
+    def _coalesce(self, channel, msgs):
+        """Joins consecutive messages as long as they fit in one IRC line"""
+        # Leave room for the command, the channel and the bot's hostmask.
+        limit = 512 - len('PRIVMSG  :\r\n') - len(channel.encode('utf-8')) \
+            - 100
+        separator = ' | '
+        coalesced = []
+        current = None
+        current_length = 0
+        for msg in msgs:
+            length = len(msg.encode('utf-8'))
+            if current is not None and \
+                    current_length + len(separator) + length <= limit:
+                current += separator + msg
+                current_length += len(separator) + length
+            else:
+                if current is not None:
+                    coalesced.append(current)
+                current = msg
+                current_length = length
+        if current is not None:
+            coalesced.append(current)
+        return coalesced
+
+    def _prepare_note(self, project_id, payload, network):
+        return {'note': payload['object_attributes']}
+
+    def _note_hook(self, context, payload):
         noteable_type = payload['object_attributes']['noteable_type']
         if noteable_type not in ['Commit', 'MergeRequest', 'Issue', 'Snippet']:
             self.log.info("Unsupported note type '%s'" % noteable_type)
@@ -162,48 +1305,494 @@ class GitlabHandler(object):
         if noteable_type == "mergerequest":
             noteable_type = "merge-request"
 
-        payload['note'] = payload['object_attributes']
+        msg = self._build_message(context.channel, 'note-' + noteable_type,
+                                  payload)
+        self._announce(context, msg, 'note-' + noteable_type)
 
-        msg = self._build_message(channel, 'note-' + noteable_type, payload)
-        self._send_message(channel, msg)
+    def _prepare_issue(self, project_id, payload, network):
+        return {'issue': payload['object_attributes']}
 
-    def _issue_hook(self, channel, payload):
+    def _issue_hook(self, context, payload):
         action = payload['object_attributes']['action']
         if action not in ['open', 'update', 'close', 'reopen']:
             self.log.info("Unsupported issue action '%s'" % action)
             return
 
-        payload['issue'] = payload['object_attributes']
+        msg = self._build_message(context.channel, 'issue-' + action, payload)
+        self._send_coalesced(context, 'issue', action, payload, msg)
 
-        msg = self._build_message(channel, 'issue-' + action, payload)
-        self._send_message(channel, msg)
+    def _prepare_merge_request(self, project_id, payload, network):
+        return {'merge_request': payload['object_attributes']}
 
-    def _merge_request_hook(self, channel, payload):
+    def _merge_request_hook(self, context, payload):
         action = payload['object_attributes']['action']
         if action not in ['open', 'update', 'close', 'reopen', 'merge']:
             self.log.info("Unsupported issue action '%s'" % action)
             return
 
-        payload['merge_request'] = payload['object_attributes']
+        msg = self._build_message(context.channel, 'merge-request-' + action,
+                                  payload)
+        self._send_coalesced(context, 'merge-request', action, payload, msg)
+
+    def _status_change(self, key, status):
+        """Returns the name of the status change, if it may be announced"""
+        if status not in ('success', 'failed', 'canceled'):
+            # Pipelines and jobs that are still running are not tracked.
+            return None
+        previous = self.statuses.update(key, status)
+        if status == 'success' and previous == 'failed':
+            return 'fixed'
+        return status
+
+    def _prepare_pipeline(self, project_id, payload, network):
+        pipeline = collections.ChainMap({}, payload['object_attributes'])
+        if 'url' not in pipeline:
+            pipeline['url'] = '%s/-/pipelines/%s' % (
+                payload['project']['web_url'], pipeline['id'])
+        return {
+            'pipeline': pipeline,
+            'status_change': self._status_change(
+                ('pipeline', project_host(payload['project']['web_url']),
+                 network, project_id, pipeline['ref']),
+                pipeline['status']),
+        }
+
+    def _prepare_job(self, project_id, payload, network):
+        derived = {
+            'status_change': self._status_change(
+                ('job', project_host(payload['repository']['homepage']),
+                 network, project_id, payload['ref'], payload['build_name']),
+                payload['build_status']),
+        }
+        if 'job_url' not in payload:
+            derived['job_url'] = '%s/-/jobs/%s' % (
+                payload['repository']['homepage'], payload['build_id'])
+        return derived
+
+    def _announce_status(self, context, kind, payload):
+        change = payload['status_change']
+        if change is None:
+            return
+        announced = self.plugin._settings.get(kind + 's.announce',
+                                              context.channel)
+        if change not in announced and \
+                not (change == 'fixed' and 'success' in announced):
+            return
+
+        msg = self._build_message(context.channel, kind + '-' + change,
+                                  payload)
+        self._announce(context, msg, kind + '-' + change)
+
+    def _pipeline_hook(self, context, payload):
+        self._announce_status(context, 'pipeline', payload)
+
+    def _job_hook(self, context, payload):
+        self._announce_status(context, 'job', payload)
+
+    def _send_coalesced(self, context, kind, action, payload, msg):
+        channel = context.channel
+        window = self.plugin._settings.get('coalesce.window', channel)
+        actions = self.plugin._settings.get('coalesce.actions', channel)
+        attributes = payload['object_attributes']
+        key = (tuple(irc.network for irc in context.ircs), context.channels,
+               payload['project']['id'], kind,
+               attributes.get('iid', attributes['id']))
+        # Collapsed announcements of other actions on the object come first.
+        self.debouncer.send_now([key + (other,) for other in actions
+                                 if other != action])
+        if not window or action not in actions:
+            self._announce(context, msg, kind + '-' + action)
+            return
 
-        msg = self._build_message(channel, 'merge-request-' + action, payload)
-        self._send_message(channel, msg)
+        key += (action,)
+        target = (context.ircs, context.channels, kind + '-' + action)
+        self.debouncer.add(key, target, msg, window)
+
+    def _send_debounced(self, target, msg, count):
+        ircs, channels, format_string_identifier = target
+        context = Announcement(ircs, channels)
+        if count > 1:
+            msg = self._build_message(context.channel, 'coalesced',
+                                      {'message': msg, 'count': count})
+        self._announce(context, msg, format_string_identifier)
+        with self._lock:
+            self.queued += context.queued
+
+    def _api_resource(self, kind, payload, channel):
+        """Returns the API resource read for the enriched format of an event
+        in <channel>, or None when no such format is rendered there"""
+        if self.api is None:
+            return None
+        if kind == 'push':
+            format_string_identifier = 'push'
+            after = payload.get('after', '')
+            resource = 'repository/commits/' + after if after.strip('0') \
+                else None
+        elif kind == 'merge-request':
+            attributes = payload['object_attributes']
+            format_string_identifier = 'merge-request-%s' % \
+                attributes.get('action')
+            resource = 'merge_requests/%s/approvals' % attributes['iid'] \
+                if attributes.get('iid') is not None else None
+        else:
+            return None
+        if resource is None or \
+                format_string_identifier not in ENRICHED_FORMATS:
+            return None
+        template = self.plugin._templates.get(
+            'format.%s-enriched' % format_string_identifier, channel)
+        if not template.format_string:
+            return None
+        return resource
+
+    def _api_get(self, project_url, path, project_id, resource):
+        """Returns the fields of the enriched formats read from <resource>
+        of a project on the API of the instance at <project_url>, or None if
+        it fails"""
+        if project_id is None:
+            return None
+        try:
+            data = self.api.get(api.instance_url(project_url, path),
+                                project_id, resource)
+        except api.ApiError as e:
+            # Announced without the data of the API
+            self.log.info('Gitlab API: %s', e)
+            return None
+        if not data:
+            return None
+        if resource.startswith('repository/commits/'):
+            if not data.get('last_pipeline'):
+                return None
+            return {'pipeline': data['last_pipeline']}
+        return {'approvals': {
+            'count': len(data.get('approved_by') or ()),
+            'required': data.get('approvals_required', 0),
+            'left': data.get('approvals_left', 0),
+        }}
+
+    def _digest_counts(self, kind, payload):
+        """Returns the digest counters incremented by an event, and its
+        author"""
+        if kind == 'push':
+            return ({'pushes': 1,
+                     'commits': payload.get('total_commits_count',
+                                            len(payload['commits']))},
+                    payload.get('user_name'))
+        author = payload.get('user')
+        author = author.get('name') if isinstance(author, dict) else None
+        action = (payload.get('object_attributes') or {}).get('action')
+        if kind == 'tag-push':
+            return {'tags': 1}, payload.get('user_name')
+        if (kind, action) in DIGEST_ACTIONS:
+            return {DIGEST_ACTIONS[kind, action]: 1}, author
+        if kind == 'note':
+            return {'comments': 1}, author
+        if kind in ('pipeline', 'job'):
+            if payload.get('status_change') != 'failed':
+                # Only failures are worth a mention.
+                return None, None
+            return {kind + 's_failed': 1}, author
+        return {'other': 1}, author
+
+    def _add_to_digest(self, context, kind, payload, interval):
+        counts, author = self._digest_counts(kind, payload)
+        if counts is None:
+            return
+        settings = self.plugin._settings
+        projects = settings.get('digest.projects', None)
+        authors = settings.get('digest.authors', None)
+        # Each channel gets a single digest of all its projects, whatever
+        # the channels they were announced with.
+        for channel in context.channels:
+            for irc in context.ircs:
+                self.digest.add((irc.network, channel), ((irc,), (channel,)),
+                                payload['project'], counts, author, interval,
+                                projects, authors)
+
+    def _send_digest(self, target, digests, more):
+        context = Announcement(*target)
+        authors = self.plugin._settings.get('digest.authors', None)
+        for digest in digests:
+            top = ', '.join('%s (%d)' % author
+                            for author in digest.authors.most_common(authors))
+            summary = digest.summary()
+            if top:
+                summary += '; by ' + top
+            msg = self._build_message(context.channel, 'digest', {
+                'project': digest.project,
+                'counts': digest.counts,
+                'authors': top,
+                'summary': summary,
+            })
+            self._announce(context, msg, 'digest')
+        if more:
+            msg = self._build_message(context.channel, 'digest-more',
+                                      {'count': more})
+            self._announce(context, msg, 'digest')
+        with self._lock:
+            self.queued += context.queued
 
     def _build_message(self, channel, format_string_identifier, args):
-        format_string = str(
-            self.plugin.registryValue(
-                'format.' +
-                format_string_identifier,
-                channel))
-        msg = format_string.format(**args)
+        start = time.perf_counter()
+        msg = None
+        if 'api' in args and format_string_identifier in ENRICHED_FORMATS:
+            template = self.plugin._templates.get(
+                'format.%s-enriched' % format_string_identifier, channel)
+            if template.format_string:
+                try:
+                    msg = template.format(args)
+                except (KeyError, IndexError, TypeError):
+                    # The API did not provide a field used by the format.
+                    msg = None
+        if msg is None:
+            template = self.plugin._templates.get(
+                'format.' + format_string_identifier, channel)
+            msg = template.format(args)
+        self.metrics.observe('gitlab_format_seconds',
+                             time.perf_counter() - start)
         return msg
 
-    def _send_message(self, channel, msg):
-        if self.plugin.registryValue('use-notices', channel):
-            announce_msg = ircmsgs.notice(channel, msg)
+    def _priority(self, format_string_identifier):
+        """Returns the priority of a message in the outbound scheduler, 0
+        being sent first"""
+        settings = self.plugin._settings
+        if format_string_identifier in settings.get('outbound.urgent', None):
+            return OutboundScheduler.URGENT
+        if format_string_identifier in settings.get('outbound.bulk', None):
+            return OutboundScheduler.BULK
+        return OutboundScheduler.NORMAL
+
+    def _announce(self, context, msg, format_string_identifier=None):
+        channels = context.channels
+        if self.plugin._settings.get('use-notices', context.channel):
+            command, make = 'NOTICE', ircmsgs.notice
         else:
-            announce_msg = ircmsgs.privmsg(channel, msg)
-        self.irc.queueMsg(announce_msg)
+            command, make = 'PRIVMSG', ircmsgs.privmsg
+        priority = None
+        if self.outbound is not None:
+            priority = self._priority(format_string_identifier)
+        for irc in context.ircs:
+            for targets in split_targets(irc, command, channels, msg):
+                context.queued += 1
+                self._queue(irc, targets, make(targets, msg), priority)
+
+    def _queue(self, irc, targets, msg, priority):
+        outbound = self.outbound
+        if outbound is None:
+            irc.queueMsg(msg)
+        else:
+            outbound.put(irc, targets, msg, priority)
+
+
+class DryRunHandler(GitlabHandler):
+
+    """Handles webhooks like GitlabHandler, counting the messages it would
+    queue without sending them or saving the projects it learns about"""
+
+    def _learn_project(self, subscription, project_id, path):
+        pass
+
+    def _queue(self, irc, targets, msg, priority):
+        pass
+
+
+class WebhookQueue(object):
+
+    """Bounded queue of received webhooks drained by a pool of workers"""
+
+    def __init__(self, process, size, workers, policy):
+        self.log = log.getPluginLogger('Gitlab')
+        self._process = process
+        self._size = size
+        self._policy = policy
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self.enqueued = 0
+        self.dropped = 0
+        self.rejected = 0
+        self._workers = []
+        for i in range(workers):
+            worker = world.SupyThread(target=self._run,
+                                      name='Gitlab webhook worker %d' % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, item):
+        """Adds <item> to the queue and returns whether it was accepted"""
+        with self._cond:
+            if self._stopped:
+                self.rejected += 1
+                return False
+            if len(self._queue) >= self._size:
+                if self._policy == 'reject':
+                    self.rejected += 1
+                    return False
+                self._queue.popleft()
+                self.dropped += 1
+            self._queue.append(item)
+            self.enqueued += 1
+            self._cond.notify()
+        return True
+
+    def stop(self, timeout=5):
+        """Processes the queued webhooks, for at most <timeout> seconds, and
+        stops the workers"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for worker in self._workers:
+            worker.join(max(0, deadline - time.monotonic()))
+        with self._cond:
+            dropped = len(self._queue)
+            self._queue.clear()
+        if dropped:
+            self.dropped += dropped
+            self.log.warning('Dropped %d queued webhook(s) while stopping.',
+                             dropped)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopped:
+                    self._cond.wait()
+                if not self._queue:
+                    # Stopped, and every queued webhook was taken.
+                    return
+                item = self._queue.popleft()
+            try:
+                self._process(*item)
+            except Exception as e:
+                self.log.exception('Failed to process queued webhook: %s', e)
+
+
+class OutboundScheduler(object):
+
+    """Sends the announcements of each network at the rate of a token
+    bucket, the most important first, taking turns between the channels
+    with the same priority so that a large push to a channel does not
+    delay the other channels"""
+
+    URGENT, NORMAL, BULK = range(3)
+
+    def __init__(self, rate, burst):
+        self.log = log.getPluginLogger('Gitlab')
+        # Returns the number of messages per second sent to a network
+        self._rate = rate
+        self._burst = burst
+        self._cond = threading.Condition()
+        # Irc -> [tokens, time of the last refill, a queue per priority,
+        # number of messages] where a queue maps targets to their messages,
+        # in turn order
+        self._networks = {}
+        self._pending = 0
+        self._stopped = False
+        self.sent = 0
+        self._thread = world.SupyThread(target=self._run,
+                                        name='Gitlab outbound scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        return self._pending
+
+    def put(self, irc, target, msg, priority):
+        with self._cond:
+            network = self._networks.get(irc)
+            if network is None:
+                network = [float(self._burst), time.monotonic(),
+                           [collections.OrderedDict()
+                            for i in range(self.BULK + 1)], 0]
+                self._networks[irc] = network
+            queues = network[2][priority]
+            if target in queues:
+                queues[target].append(msg)
+            else:
+                queues[target] = collections.deque([msg])
+            network[3] += 1
+            self._pending += 1
+            self._cond.notify()
+
+    def _next(self, network):
+        for queue in network[2]:
+            if queue:
+                target, msgs = queue.popitem(last=False)
+                msg = msgs.popleft()
+                if msgs:
+                    # The target waits for the others to take their turn.
+                    queue[target] = msgs
+                network[3] -= 1
+                self._pending -= 1
+                return msg
+        return None
+
+    def _take(self):
+        """Returns the messages that may be sent now, and how long to wait
+        before the next one"""
+        now = time.monotonic()
+        rate = self._rate()
+        ready = []
+        delay = None
+        for irc, network in list(self._networks.items()):
+            if rate == float('inf'):
+                tokens = self._burst
+            else:
+                tokens = min(self._burst,
+                             network[0] + (now - network[1]) * rate)
+            network[1] = now
+            while tokens >= 1:
+                msg = self._next(network)
+                if msg is None:
+                    break
+                tokens -= 1
+                ready.append((irc, msg))
+            network[0] = tokens
+            if network[3]:
+                wait = (1 - tokens) / rate
+                delay = wait if delay is None else min(delay, wait)
+            elif tokens >= self._burst:
+                del self._networks[irc]
+        return ready, delay
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                ready, delay = self._take()
+                if not ready:
+                    self._cond.wait(delay)
+                    continue
+            for irc, msg in ready:
+                try:
+                    irc.queueMsg(msg)
+                except Exception as e:
+                    self.log.exception('Failed to send an announcement: %s',
+                                       e)
+                self.sent += 1
+
+    def stop(self, timeout=5):
+        """Stops the scheduler and hands the pending messages to their
+        network"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        with self._cond:
+            for irc, network in self._networks.items():
+                while True:
+                    msg = self._next(network)
+                    if msg is None:
+                        break
+                    irc.queueMsg(msg)
+            self._networks = {}
 
 
 class GitlabWebHookService(httpserver.SupyHTTPServerCallback):
@@ -216,21 +1805,277 @@ class GitlabWebHookService(httpserver.SupyHTTPServerCallback):
         self.log = log.getPluginLogger('Gitlab')
         self.gitlab = GitlabHandler(plugin)
         self.plugin = plugin
-
-    def _send_error(self, handler, message):
-        handler.send_response(403)
+        self.queue = None
+        if plugin.registryValue('queue.enabled'):
+            self.queue = WebhookQueue(self._process_queued,
+                                      plugin.registryValue('queue.size'),
+                                      plugin.registryValue('queue.workers'),
+                                      plugin.registryValue('queue.policy'))
+        self.spool = None
+        self._spool_event = None
+        self._replaying = set()
+        if plugin.registryValue('spool.enabled'):
+            self.spool = spool.Spool(
+                conf.supybot.directories.data.dirize('Gitlab.spool'),
+                plugin.registryValue('spool.segmentSize'),
+                plugin.registryValue('spool.maxSize'),
+                plugin.registryValue('spool.maxAge'),
+                plugin.registryValue('spool.syncInterval'))
+            self._spool_event = schedule.addPeriodicEvent(
+                self._check_spool, plugin.registryValue('spool.syncInterval'),
+                'Gitlab spool', now=False)
+        if plugin.registryValue('outbound.enabled'):
+            self.gitlab.outbound = OutboundScheduler(
+                self._outbound_rate, plugin.registryValue('outbound.burst'))
+        self.recorder = None
+        if plugin.registryValue('capture.enabled'):
+            self.recorder = capture.Recorder(
+                conf.supybot.directories.data.dirize(
+                    plugin.registryValue('capture.file')),
+                plugin.registryValue('capture.maxSize'))
+        if plugin.registryValue('api.enabled'):
+            self.gitlab.api = api.Client(
+                conf.supybot.plugins.Gitlab.api.token,
+                plugin.registryValue('api.timeout'),
+                plugin.registryValue('api.cacheSize'),
+                plugin.registryValue('api.cacheTtl'),
+                plugin.registryValue('api.poolSize'))
+        plugin._metrics.add_collector(self._collect_metrics)
+
+    def _outbound_rate(self):
+        rate = self.plugin.registryValue('outbound.rate')
+        if rate <= 0:
+            # Keep up with the flood control of Limnoria
+            throttle = conf.supybot.protocols.irc.throttleTime()
+            rate = 1. / throttle if throttle > 0 else float('inf')
+        return rate
+
+    def _collect_metrics(self):
+        for event_type in self.gitlab.event_types.values():
+            yield ('gitlab_events_routed_total', 'counter',
+                   'Channels events were announced to, by event type.',
+                   (('event', event_type.name),), event_type.routed)
+        if self.queue is not None:
+            yield ('gitlab_queue_depth', 'gauge',
+                   'Webhooks waiting to be processed.', (), len(self.queue))
+            for name, value in (('enqueued', self.queue.enqueued),
+                                ('dropped', self.queue.dropped),
+                                ('rejected', self.queue.rejected)):
+                yield ('gitlab_queue_%s_total' % name, 'counter',
+                       'Webhooks %s by the queue.' % name, (), value)
+        outbound = self.gitlab.outbound
+        if outbound is not None:
+            yield ('gitlab_outbound_depth', 'gauge',
+                   'Announcements waiting for the outbound scheduler.', (),
+                   len(outbound))
+            yield ('gitlab_outbound_sent_total', 'counter',
+                   'Announcements sent by the outbound scheduler.', (),
+                   outbound.sent)
+        client = self.gitlab.api
+        if client is not None:
+            for result, value in list(client.counts.items()):
+                yield ('gitlab_api_calls_total', 'counter',
+                       'Calls to the API of the Gitlab instances, by result.',
+                       (('result', result),), value)
+        if self.recorder is not None:
+            yield ('gitlab_capture_recorded_total', 'counter',
+                   'Webhooks recorded to the capture.', (),
+                   self.recorder.recorded)
+            yield ('gitlab_capture_dropped_total', 'counter',
+                   'Webhooks not recorded because the capture is full.', (),
+                   self.recorder.dropped)
+        if self.spool is not None:
+            yield ('gitlab_spool_dropped_total', 'counter',
+                   'Spooled webhooks dropped because of their age or the '
+                   'size of the spool.', (), self.spool.dropped)
+
+    def stop(self):
+        if self.queue is not None:
+            self.queue.stop()
+        if self._spool_event is not None:
+            try:
+                schedule.removePeriodicEvent(self._spool_event)
+            except KeyError:
+                pass
+        if self.spool is not None:
+            self.spool.close()
+        self.gitlab.debouncer.flush()
+        self.gitlab.digest.flush()
+        if self.gitlab.outbound is not None:
+            self.gitlab.outbound.stop()
+        if self.gitlab.api is not None:
+            self.gitlab.api.close()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def _send_response(self, handler, code, message):
+        handler.send_response(code)
         handler.send_header('Content-type', 'text/plain')
         handler.end_headers()
         handler.wfile.write(message.encode('utf-8'))
 
+    def _send_error(self, handler, message):
+        self._send_response(handler, 403, message)
+
     def _send_ok(self, handler):
+        self._send_response(handler, 200, 'OK')
+
+    def _send_accepted(self, handler):
+        self._send_response(handler, 202, 'Accepted')
+
+    def _send_too_large(self, handler):
+        self._send_response(handler, 413, _('Error: Payload too large.'))
+
+    def _send_unavailable(self, handler):
+        self._send_response(handler, 503,
+                            _('Error: Too many queued webhooks.'))
+
+    def _error(self, kind, metrics=None):
+        (metrics or self.plugin._metrics).inc('gitlab_errors_total',
+                                              (('kind', kind),))
+
+    def _process_queued(self, headers, form, network, gitlab=None):
+        gitlab = gitlab or self.gitlab
+        irc = None
+        if network is not None:
+            irc = world.getIrc(network)
+        if network is not None and irc is None:
+            self.log.info('Dropping queued webhook for unknown network %r',
+                          network)
+            self._error('unknown_network', gitlab.metrics)
+            return
+        try:
+            payload = self._decode(form, gitlab.metrics)
+        except Exception as e:
+            self.log.info('Invalid JSON data: %s', e)
+            self._error('invalid_json', gitlab.metrics)
+            return
+        try:
+            gitlab.handle_payload(headers, payload, irc)
+        except Exception:
+            self._error('invalid_data', gitlab.metrics)
+            raise
+
+    def replay(self, path, speed, gitlab, network=None):
+        """Announces the webhooks captured in <path> through <gitlab>, a
+        GitlabHandler, at <speed> times the rate they were received (as
+        fast as possible if 0) and to <network> if given instead of the
+        network they were received for; returns the number of webhooks, of
+        errors and the elapsed seconds"""
+        errors = []
+
+        def process(record):
+            try:
+                self._process_queued(
+                    record['headers'], capture.body(record),
+                    record['network'] if network is None else network,
+                    gitlab)
+            except Exception as e:
+                self.log.info('Failed to replay captured webhook: %s', e)
+                errors.append(e)
+
+        count, elapsed = capture.replay(capture.read(path), process, speed)
+        # Announce what is left to collapse.
+        gitlab.debouncer.flush()
+        gitlab.digest.flush()
+        return count, len(errors), elapsed
+
+    def _connected(self, irc):
+        return irc is not None and not irc.zombie and irc.afterConnect \
+            and len(irc.state.channels) > 0
+
+    def _should_spool(self, network, irc):
+        if self.spool is None or network is None:
+            return False
+        if irc is None:
+            return network in conf.supybot.networks()
+        # Keep the order of the webhooks while older ones are replayed.
+        return not self._connected(irc) or self.spool.pending(network)
+
+    def _check_spool(self):
+        """Flushes the spool and replays it for networks that are back"""
+        self.spool.sync()
+        self.spool.compact()
+        for network in self.spool.networks():
+            if network in self._replaying or \
+                    not self._connected(world.getIrc(network)):
+                continue
+            self._replaying.add(network)
+            thread = world.SupyThread(target=self._replay_spool,
+                                      args=(network,),
+                                      name='Gitlab spool replay %s' % network)
+            thread.daemon = True
+            thread.start()
+
+    def _replay_spool(self, network):
+        def process(headers, form):
+            if not self._connected(world.getIrc(network)):
+                # Disconnected again, the rest is replayed later.
+                return False
+            try:
+                self._process_queued(headers, form, network)
+            except Exception as e:
+                self.log.exception('Failed to replay spooled webhook: %s', e)
+        try:
+            self.spool.replay(network, process)
+        finally:
+            self._replaying.discard(network)
+
+    def _too_large(self, headers, form):
+        limit = self.plugin.registryValue('webhook.maxSize')
+        if not limit:
+            return False
+        try:
+            length = int(headers.get('Content-Length', len(form)))
+        except ValueError:
+            length = len(form)
+        return max(length, len(form)) > limit
+
+    def _decode(self, form, metrics=None):
+        start = time.perf_counter()
+        payload = json.loads(form.decode('utf-8'))
+        (metrics or self.plugin._metrics).observe(
+            'gitlab_parse_seconds', time.perf_counter() - start)
+        return payload
+
+    def doGet(self, handler, path):
+        if path.rstrip('/') != '/metrics':
+            super(GitlabWebHookService, self).doGet(handler, path)
+            return
         handler.send_response(200)
-        handler.send_header('Content-type', 'text/plain')
+        handler.send_header('Content-type', 'text/plain; version=0.0.4')
         handler.end_headers()
-        handler.wfile.write(bytes('OK', 'utf-8'))
+        handler.wfile.write(self.plugin._metrics.render().encode('utf-8'))
+
+    def _check_token(self, headers, network):
+        """Checks the secret token of a webhook before its body is decoded;
+        the tokens of the projects are checked again once it is routed"""
+        token = headers.get('X-Gitlab-Token')
+        group = conf.supybot.plugins.Gitlab.webhook
+        if network is None:
+            # Announced on the networks whose token it carries, or which
+            # have none; the others are left out once it is decoded.
+            matches = [network_token_matches(irc.network, token)
+                       for irc in world.ircs if not irc.zombie]
+            if True in matches:
+                return True
+            if matches and None not in matches:
+                return False
+        else:
+            matches = network_token_matches(network, token)
+            if matches is not None:
+                return matches
+        index = self.plugin._index
+        if token is not None and index.knows_token(token):
+            return True
+        # Tokens are ignored until they are configured on this side.
+        return not group.requireToken() and \
+            (token is None or not index.has_tokens())
 
     def doPost(self, handler, path, form):
-        headers = dict(self.headers)
+        # The headers of the request, not the ones the HTTP server stores on
+        # this callback, which may be those of another request by now
+        headers = dict(handler.headers)
 
         network = None
         try:
@@ -241,24 +2086,71 @@ class GitlabWebHookService(httpserver.SupyHTTPServerCallback):
                                         network name in the URL."""))
             return
 
-        irc = world.getIrc(network)
-        if irc is None:
+        irc = None
+        if network in ('', '*'):
+            # Announced on every network the bot is connected to
+            network = None
+        else:
+            irc = world.getIrc(network)
+        if network is not None and irc is None and \
+                not self._should_spool(network, irc):
+            self._error('unknown_network')
             self._send_error(handler, (_('Error: Unknown network %r') % network))
             return
 
+        if self._too_large(headers, form):
+            self._error('too_large')
+            self._send_too_large(handler)
+            return
+
+        if not self._check_token(headers, network):
+            self._error('invalid_token')
+            self._send_error(handler, _('Error: Invalid token.'))
+            return
+
+        if self.recorder is not None and isinstance(form, bytes):
+            self.recorder.record(network, headers, form)
+
+        if self._should_spool(network, irc):
+            if 'X-Gitlab-Event' not in headers:
+                self._error('missing_event')
+                self._send_error(handler, _('Error: Invalid data sent.'))
+                return
+            if not isinstance(form, bytes):
+                # Form fields, parsed by the HTTP server
+                self._error('invalid_json')
+                self._send_error(handler, _('Error: Invalid JSON data sent.'))
+                return
+            self.spool.append(network, headers, form)
+            self._send_accepted(handler)
+            return
+
+        if self.queue is not None:
+            if 'X-Gitlab-Event' not in headers:
+                self._error('missing_event')
+                self._send_error(handler, _('Error: Invalid data sent.'))
+            elif self.queue.put((headers, form, network)):
+                self._send_accepted(handler)
+            else:
+                self._error('queue_full')
+                self._send_unavailable(handler)
+            return
+
         # Handle payload
         payload = None
         try:
-            payload = json.JSONDecoder().decode(form.decode('utf-8'))
+            payload = self._decode(form)
         except Exception as e:
-            self.log.info(e)
+            self.log.info('Invalid JSON data: %s', e)
+            self._error('invalid_json')
             self._send_error(handler, _('Error: Invalid JSON data sent.'))
             return
 
         try:
             self.gitlab.handle_payload(headers, payload, irc)
         except Exception as e:
-            self.log.info(e)
+            self.log.info('Invalid data: %s', e)
+            self._error('invalid_data')
             self._send_error(handler, _('Error: Invalid data sent.'))
             return
 
@@ -279,23 +2171,174 @@ class Gitlab(callbacks.Plugin):
         self.__parent.__init__(irc)
         instance = self
 
-        callback = GitlabWebHookService(self)
-        httpserver.hook('gitlab', callback)
+        self._index = ProjectIndex()
+        self._metrics = Metrics()
+        group = conf.supybot.plugins.get(self.name())
+        self._templates = ChannelValueCache(
+            group, lambda value: Template(str(value)))
+        self._settings = ChannelValueCache(group)
+        self._store = store.ProjectStore(
+            conf.supybot.directories.data.dirize('Gitlab.db'))
+        self._watched = {}
+        # Registered as is so that removeCallback() finds it
+        self._watch_callback = self._migrate_channel
+        self._migrate_projects()
+        self._build_index()
+
+        self._webhook = GitlabWebHookService(self)
+        httpserver.hook('gitlab', self._webhook)
 
     def die(self):
         httpserver.unhook('gitlab')
+        self._webhook.stop()
+        for value in self._watched.values():
+            value.removeCallback(self._watch_callback)
+        self._templates.close()
+        self._settings.close()
+        self._store.close()
 
         self.__parent.die()
 
     def _load_projects(self, channel):
-        projects = self.registryValue('projects', channel)
-        if projects is None:
-            return {}
-        else:
-            return projects
+        return self._store.projects(channel)
 
     def _save_projects(self, projects, channel):
-        self.setRegistryValue('projects', value=projects, channel=channel)
+        self._store.update({channel: projects}, replace=True)
+        self._reindex_channel(channel)
+
+    def _learn_project(self, subscription, project_id, path):
+        """Saves the id and path of the project of <subscription>, which
+        was found by its url or path"""
+        entry = self._store.get(subscription.channel, subscription.slug)
+        if entry is None:
+            return
+        settings = dict(project_settings(entry))
+        if settings['url'] != subscription.url or 'id' in settings:
+            return
+        settings['id'] = project_id
+        if path:
+            settings['path'] = path
+        self.log.info('Learned the id %s of the project %s of %s.',
+                      project_id, subscription.slug, subscription.channel)
+        self._set_project(subscription.channel, subscription.slug, settings)
+
+    def _set_project(self, channel, slug, entry):
+        self._store.set(channel, slug, entry)
+        self._reindex_channel(channel)
+
+    def _import_projects(self, subscriptions):
+        """Adds the projects of <subscriptions> and returns their number"""
+        if not isinstance(subscriptions, dict):
+            raise ValueError(_('channels must be given as an object'))
+        # Channels differing only by case are the same channel.
+        merged = collections.OrderedDict()
+        for channel, projects in subscriptions.items():
+            if not ircutils.isChannel(channel) or \
+                    not isinstance(projects, dict):
+                raise ValueError(_('invalid projects of %r') % channel)
+            for slug, entry in projects.items():
+                if not self._valid_project(entry):
+                    raise ValueError(_('invalid project %r of %r') %
+                                     (slug, channel))
+            merged.setdefault(ircutils.toLower(channel), {}).update(projects)
+        self._store.update(merged)
+        for channel in merged:
+            self._reindex_channel(channel)
+        return sum(len(projects) for projects in merged.values())
+
+    def _valid_project(self, entry):
+        """Returns whether <entry> holds settings the project commands could
+        have stored"""
+        if not isinstance(entry, (str, dict)):
+            return False
+        settings = project_settings(entry)
+        if not isinstance(settings.get('url'), str):
+            return False
+        for name in ('token', 'path'):
+            if name in settings and not isinstance(settings[name], str):
+                return False
+        if 'id' in settings and (not isinstance(settings['id'], int) or
+                                 isinstance(settings['id'], bool)):
+            return False
+        for rule in FILTER_RULES:
+            values = settings.get(rule, [])
+            if not isinstance(values, list) or \
+                    not all(isinstance(value, str) for value in values):
+                return False
+        kinds = set(event_type.kind for event_type in
+                    self._webhook.gitlab.event_types.values())
+        return all(kind in kinds for kind in settings.get('events', ()))
+
+    def _data_file(self, irc, filename):
+        """Returns the path of <filename> in the data directory"""
+        if os.path.basename(filename) != filename or \
+                filename in (os.curdir, os.pardir):
+            irc.error(_('The file must be in the data directory.'))
+            return None
+        return conf.supybot.directories.data.dirize(filename)
+
+    def _migrate_projects(self):
+        """Moves the projects saved in the registry to the store"""
+        group = conf.supybot.plugins.get(self.name()).get('projects')
+        for channel, value in group.getValues(fullNames=False):
+            if channel.startswith(':'):
+                # Network-specific values are not used by this plugin.
+                continue
+            self._migrate_channel(channel)
+
+    def _watch_channel(self, channel):
+        """Moves the projects set through the registry to the store"""
+        value = self.registryValue('projects', channel, value=False)
+        if value._name not in self._watched:
+            value.addCallback(self._watch_callback, channel)
+            self._watched[value._name] = value
+
+    def _migrate_channel(self, channel):
+        projects = self.registryValue('projects', channel)
+        if projects:
+            # Added to the projects of the channel: the value may be set
+            # again after the projects were changed with commands.
+            self._store.update({channel: projects})
+            self._reindex_channel(channel)
+            self.setRegistryValue('projects', value={}, channel=channel)
+
+    def _build_index(self):
+        """Indexes the projects of every channel that has subscriptions"""
+        self._index.clear()
+        for channel in self._store.channels():
+            self._reindex_channel(channel)
+
+    def _reindex_channel(self, channel):
+        self._watch_channel(channel)
+        self._index.update(ircutils.toLower(channel),
+                           self._load_projects(channel))
+
+    def _stats(self):
+        def counts(name):
+            values = self._metrics.counter(name)
+            total = sum(values.values())
+            details = ', '.join('%s: %d' % (labels[0][1], value)
+                                for labels, value in sorted(values.items()))
+            return '%d (%s)' % (total, details) if details else '0'
+
+        def average(name):
+            count, total = self._metrics.histogram(name)
+            return total / count * 1000 if count else 0
+
+        stats = [
+            _('Webhooks: %s') % counts('gitlab_webhooks_total'),
+            _('Errors: %s') % counts('gitlab_errors_total'),
+            _('Messages queued: %d') % self._webhook.gitlab.queued,
+            _('Average parse/routing/format time: %.3f/%.3f/%.3f ms') % (
+                average('gitlab_parse_seconds'),
+                average('gitlab_routing_seconds'),
+                average('gitlab_format_seconds')),
+        ]
+        queue = self._webhook.queue
+        if queue is not None:
+            stats.append(_('Queue: %d waiting, %d dropped, %d rejected') %
+                         (len(queue), queue.dropped, queue.rejected))
+        return '; '.join(stats)
 
     def _check_capability(self, irc, msg):
         if ircdb.checkCapability(msg.prefix, 'admin'):
@@ -307,6 +2350,77 @@ class Gitlab(callbacks.Plugin):
     class gitlab(callbacks.Commands):
         """Gitlab commands"""
 
+        @internationalizeDocstring
+        def stats(self, irc, msg, args):
+            """takes no arguments
+
+            Returns statistics about the processed webhooks.
+            """
+            if not instance._check_capability(irc, msg):
+                return
+
+            irc.reply(instance._stats())
+
+        stats = wrap(stats)
+
+        @internationalizeDocstring
+        def replay(self, irc, msg, args, optlist, network, filename, speed):
+            """[--dry-run] [--duplicates] <network> <filename> [<speed>]
+
+            Announces the webhooks recorded in <filename>, a capture of the
+            data directory, on <network>, <speed> times as fast as they were
+            received (defaults to 1), or as fast as possible if <speed> is 0.
+            Replies with the throughput and the number of messages queued.
+            With --dry-run, the messages are only counted and the project ids
+            are not learned. Webhooks already announced on <network> are
+            skipped, unless --duplicates is given. Replayed webhooks are not
+            counted in the metrics of the received ones.
+            """
+            if not instance._check_capability(irc, msg):
+                return
+
+            options = dict(optlist)
+            if world.getIrc(network) is None:
+                irc.errorInvalid(_('network'), network)
+                return
+            if speed is not None and speed < 0:
+                irc.errorInvalid(_('speed'), speed)
+                return
+            path = instance._data_file(irc, filename)
+            if path is None:
+                return
+            live = instance._webhook.gitlab
+            if 'dry-run' in options:
+                gitlab = DryRunHandler(instance)
+            else:
+                gitlab = GitlabHandler(instance)
+                gitlab.outbound = live.outbound
+            gitlab.api = live.api
+            gitlab.metrics = Metrics()
+            if 'duplicates' not in options:
+                # Retries of the replayed webhooks are skipped as well.
+                gitlab.deliveries = live.deliveries.copy()
+            try:
+                count, errors, elapsed = instance._webhook.replay(
+                    path, 1.0 if speed is None else speed, gitlab, network)
+            except (IOError, ValueError) as e:
+                irc.error(_('Could not replay %s: %s') % (filename, e))
+                return
+
+            if 'dry-run' in options:
+                reply = _('%d webhook(s) replayed in %.1f seconds (%.1f/s), '
+                          '%d message(s) not sent, %d error(s).')
+            else:
+                reply = _('%d webhook(s) replayed in %.1f seconds (%.1f/s), '
+                          '%d message(s) queued, %d error(s).')
+            irc.reply(reply % (count, elapsed,
+                               count / elapsed if elapsed else 0,
+                               gitlab.queued, errors))
+
+        replay = wrap(replay, [getopts({'dry-run': '', 'duplicates': ''}),
+                               'somethingWithoutSpaces',
+                               'somethingWithoutSpaces', optional('float')])
+
         class project(callbacks.Commands):
             """Project commands"""
 
@@ -320,15 +2434,13 @@ class Gitlab(callbacks.Plugin):
                 if not instance._check_capability(irc, msg):
                     return
 
-                projects = instance._load_projects(channel)
-                if project_slug in projects:
+                if instance._store.get(channel, project_slug) is not None:
                     irc.error(
                         _('This project is already announced to this channel.'))
                     return
 
                 # Save new project mapping
-                projects[project_slug] = project_url
-                instance._save_projects(projects, channel)
+                instance._set_project(channel, project_slug, project_url)
 
                 irc.replySuccess()
 
@@ -344,38 +2456,224 @@ class Gitlab(callbacks.Plugin):
                 if not instance._check_capability(irc, msg):
                     return
 
-                projects = instance._load_projects(channel)
-                if project_slug not in projects:
+                # Remove project mapping
+                if not instance._store.remove(channel, project_slug):
                     irc.error(
                         _('This project is not registered to this channel.'))
                     return
-
-                # Remove project mapping
-                del projects[project_slug]
-                instance._save_projects(projects, channel)
+                instance._reindex_channel(channel)
 
                 irc.replySuccess()
 
             remove = wrap(remove, ['channel', 'somethingWithoutSpaces'])
 
             @internationalizeDocstring
-            def list(self, irc, msg, args, channel):
-                """[<channel>]
+            def list(self, irc, msg, args, channel, page):
+                """[<channel>] [<page>]
 
-                Lists the registered projects in <channel>.
+                Lists the registered projects in <channel>, <page> (the first
+                one by default) of them at a time.
                 """
                 if not instance._check_capability(irc, msg):
                     return
 
-                projects = instance._load_projects(channel)
-                if projects is None or len(projects) == 0:
+                count = instance._store.count(channel)
+                if count == 0:
                     irc.error(_('This channel has no registered projects.'))
                     return
 
-                for project_slug, project_url in projects.items():
-                    irc.reply("%s: %s" % (project_slug, project_url))
+                size = instance.registryValue('pageSize')
+                pages = (count + size - 1) // size
+                page = min(page or 1, pages)
+                entries = []
+                for project_slug, entry in instance._store.page(
+                        channel, (page - 1) * size, size):
+                    settings = project_settings(entry)
+                    rules = ['%s: %s' % (rule, ' '.join(settings[rule]))
+                             for rule in FILTER_RULES if settings.get(rule)]
+                    if 'id' in settings:
+                        rules.insert(0, 'id: %s' % settings['id'])
+                    if rules:
+                        entries.append("%s: %s (%s)" % (project_slug,
+                                                        settings['url'],
+                                                        '; '.join(rules)))
+                    else:
+                        entries.append("%s: %s" % (project_slug,
+                                                   settings['url']))
+                reply = ', '.join(entries)
+                if pages > 1:
+                    reply += _(' (page %d of %d)') % (page, pages)
+                irc.reply(reply)
+
+            list = wrap(list, ['channel', optional('positiveInt')])
+
+            @internationalizeDocstring
+            def token(self, irc, msg, args, channel, project_slug, token):
+                """[<channel>] <project-slug> [<token>]
+
+                Sets the secret token Gitlab sends with the webhooks of the
+                project <project-slug> announced to <channel>. Webhooks of
+                this project without this token are not announced to
+                <channel>. Without <token>, the token is removed. Use this
+                command in private.
+                """
+                if not instance._check_capability(irc, msg):
+                    return
+
+                entry = instance._store.get(channel, project_slug)
+                if entry is None:
+                    irc.error(
+                        _('This project is not registered to this channel.'))
+                    return
+
+                settings = dict(project_settings(entry))
+                if token:
+                    settings['token'] = token
+                else:
+                    settings.pop('token', None)
+                instance._set_project(channel, project_slug,
+                                      project_entry(settings))
+
+                irc.replySuccess()
+
+            token = wrap(token, ['channel', 'somethingWithoutSpaces',
+                                 optional('somethingWithoutSpaces')])
+
+            @internationalizeDocstring
+            def id(self, irc, msg, args, channel, project_slug, project_id):
+                """[<channel>] <project-slug> [<project-id>]
+
+                Sets the id of the project <project-slug> announced to
+                <channel>, so that its events are recognized even after it
+                is renamed. The id is otherwise learned from the first event
+                of the project carrying a secret token. Without
+                <project-id>, it is learned again.
+                """
+                if not instance._check_capability(irc, msg):
+                    return
+
+                entry = instance._store.get(channel, project_slug)
+                if entry is None:
+                    irc.error(
+                        _('This project is not registered to this channel.'))
+                    return
+
+                settings = dict(project_settings(entry))
+                settings.pop('path', None)
+                if project_id:
+                    settings['id'] = project_id
+                else:
+                    settings.pop('id', None)
+                instance._set_project(channel, project_slug,
+                                      project_entry(settings))
+
+                irc.replySuccess()
+
+            id = wrap(id, ['channel', 'somethingWithoutSpaces',
+                           optional('positiveInt')])
+
+            @internationalizeDocstring
+            def filter(self, irc, msg, args, channel, project_slug, rule,
+                       values):
+                """[<channel>] <project-slug> {events|actions|refs|authors|exclude-authors} [<value> ...]
+
+                Restricts the events of the project <project-slug> announced
+                to <channel> to the given event types (push, tag-push, note,
+                issue, merge-request, pipeline, job), issue and merge
+                request actions, branches or tags (globs such as release/*)
+                or authors, or excludes the events of the given authors.
+                Without <value>, the rule is removed.
+                """
+                if not instance._check_capability(irc, msg):
+                    return
+
+                entry = instance._store.get(channel, project_slug)
+                if entry is None:
+                    irc.error(
+                        _('This project is not registered to this channel.'))
+                    return
+
+                if rule == 'events':
+                    kinds = set(event_type.kind for event_type in
+                                instance._webhook.gitlab.event_types.values())
+                    unknown = [value for value in values
+                               if value not in kinds]
+                    if unknown:
+                        irc.error(_('Unknown event type(s): %s') %
+                                  ', '.join(unknown))
+                        return
+
+                settings = dict(project_settings(entry))
+                if values:
+                    settings[rule] = values
+                else:
+                    settings.pop(rule, None)
+                instance._set_project(channel, project_slug,
+                                      project_entry(settings))
+
+                irc.replySuccess()
+
+            filter = wrap(filter, ['channel', 'somethingWithoutSpaces',
+                                   ('literal', FILTER_RULES),
+                                   any('something')])
+
+            @internationalizeDocstring
+            def import_(self, irc, msg, args, filename):
+                """<filename>
+
+                Subscribes the channels to the projects of <filename>, a
+                file of the data directory written by the export command:
+                a JSON object mapping channels to objects mapping project
+                slugs to their url (or settings). Projects already
+                subscribed to with the same slug are replaced.
+                """
+                if not instance._check_capability(irc, msg):
+                    return
+
+                path = instance._data_file(irc, filename)
+                if path is None:
+                    return
+                try:
+                    with open(path) as fd:
+                        subscriptions = json.load(fd)
+                    count = instance._import_projects(subscriptions)
+                except (IOError, ValueError) as e:
+                    irc.error(_('Could not import %s: %s') % (filename, e))
+                    return
+
+                irc.reply(_('%d project(s) imported.') % count)
+
+            # import is a keyword.
+            locals()['import'] = wrap(import_, ['somethingWithoutSpaces'])
+            del import_
+
+            @internationalizeDocstring
+            def export(self, irc, msg, args, filename):
+                """<filename>
+
+                Writes the projects subscribed by every channel to
+                <filename> in the data directory, in the format read by the
+                import command.
+                """
+                if not instance._check_capability(irc, msg):
+                    return
+
+                path = instance._data_file(irc, filename)
+                if path is None:
+                    return
+                subscriptions = instance._store.export()
+                try:
+                    with open(path, 'w') as fd:
+                        json.dump(subscriptions, fd, indent=4)
+                except IOError as e:
+                    irc.error(_('Could not export %s: %s') % (filename, e))
+                    return
+
+                irc.reply(_('%d project(s) exported.') %
+                          sum(len(projects)
+                              for projects in subscriptions.values()))
 
-            list = wrap(list, ['channel'])
+            export = wrap(export, ['somethingWithoutSpaces'])
 
 
 Class = Gitlab
@@ -0,0 +1,287 @@
+###
+# Copyright (c) 2015, Moritz Lipp
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Append-only on-disk spool of webhooks received for networks the bot is not
+connected to.
+
+Each network has its own directory of numbered segment files. A segment is a
+sequence of records, each made of a header (receive time, length of the
+headers, length of the body) followed by the JSON-encoded headers and the raw
+body. Segments are rotated once they reach a maximum size and deleted once
+they are replayed or expired.
+"""
+
+import json
+import os
+import struct
+import threading
+import time
+
+RECORD_HEADER = struct.Struct('>dII')
+SEGMENT_SUFFIX = '.seg'
+
+
+def _read_records(path):
+    """Yields (offset, timestamp, headers, body) for every complete record of
+    the segment at <path>; a truncated record ends the segment."""
+    with open(path, 'rb') as fd:
+        offset = 0
+        while True:
+            header = fd.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, headers_length, body_length = \
+                RECORD_HEADER.unpack(header)
+            headers = fd.read(headers_length)
+            body = fd.read(body_length)
+            if len(headers) < headers_length or len(body) < body_length:
+                return
+            yield offset, timestamp, json.loads(headers.decode('utf-8')), body
+            offset = fd.tell()
+
+
+class Spool(object):
+
+    """Stores webhooks per network on disk until they can be replayed"""
+
+    def __init__(self, directory, segment_size, max_size, max_age,
+                 sync_interval):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.max_age = max_age
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        # network -> [file, path, size] of the segment being written
+        self._writers = {}
+        # network -> path of the segment being replayed
+        self._replaying = {}
+        # network -> bytes of its segments, read from the disk when first
+        # needed
+        self._sizes = {}
+        self._last_sync = time.time()
+        self._unsynced = False
+        self._pending = set(self.networks())
+        self.dropped = 0
+
+    def _network_directory(self, network):
+        return os.path.join(self.directory,
+                            network.lower().replace(os.sep, '_'))
+
+    def _segments(self, network):
+        directory = self._network_directory(network)
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return []
+        return [os.path.join(directory, name) for name in sorted(names)
+                if name.endswith(SEGMENT_SUFFIX)]
+
+    def networks(self):
+        """Returns the networks with spooled webhooks"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return [name for name in names if self._segments(name)]
+
+    def pending(self, network):
+        """Returns whether webhooks of <network> wait to be replayed"""
+        return network.lower() in self._pending
+
+    def append(self, network, headers, body):
+        record = json.dumps(headers).encode('utf-8')
+        data = RECORD_HEADER.pack(time.time(), len(record), len(body)) + \
+            record + body
+        with self._lock:
+            writer = self._writers.get(network.lower())
+            if writer is None or writer[2] >= self.segment_size:
+                if writer is not None:
+                    self._seal(network)
+                writer = self._open(network)
+            self._pending.add(network.lower())
+            writer[0].write(data)
+            writer[0].flush()
+            writer[2] += len(data)
+            self._resize(network, len(data))
+            self._unsynced = True
+            if time.time() - self._last_sync >= self.sync_interval:
+                self._sync()
+            self._enforce_size(network)
+
+    def _open(self, network):
+        directory = self._network_directory(network)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        segments = self._segments(network)
+        if segments:
+            number = int(os.path.basename(segments[-1])[:-len(SEGMENT_SUFFIX)])
+        else:
+            number = 0
+        path = os.path.join(directory,
+                            '%020d%s' % (number + 1, SEGMENT_SUFFIX))
+        writer = [open(path, 'ab'), path, 0]
+        self._writers[network.lower()] = writer
+        return writer
+
+    def _seal(self, network):
+        writer = self._writers.pop(network.lower(), None)
+        if writer is not None:
+            writer[0].flush()
+            os.fsync(writer[0].fileno())
+            writer[0].close()
+
+    def _sync(self):
+        for writer in self._writers.values():
+            os.fsync(writer[0].fileno())
+        self._last_sync = time.time()
+        self._unsynced = False
+
+    def sync(self):
+        """Flushes the spooled webhooks to disk"""
+        with self._lock:
+            if self._unsynced:
+                self._sync()
+
+    def _busy(self, network):
+        """Returns the paths of the segments of <network> being written or
+        replayed"""
+        writer = self._writers.get(network.lower())
+        return (writer and writer[1], self._replaying.get(network.lower()))
+
+    def _resize(self, network, delta):
+        """Adds <delta> bytes to the size of the segments of <network>"""
+        key = network.lower()
+        if key not in self._sizes:
+            # Read once the change is made on the disk
+            self._sizes[key] = sum(os.path.getsize(path)
+                                   for path in self._segments(network))
+        else:
+            self._sizes[key] += delta
+
+    def _enforce_size(self, network):
+        if self._sizes.get(network.lower(), 0) <= self.max_size:
+            return
+        segments = self._segments(network)
+        sizes = [os.path.getsize(path) for path in segments]
+        total = sum(sizes)
+        busy = self._busy(network)
+        for path, size in zip(segments, sizes):
+            if total <= self.max_size:
+                break
+            # The oldest segments are dropped, never the ones being written
+            # or replayed.
+            if path in busy:
+                continue
+            self.dropped += sum(1 for record in _read_records(path))
+            os.remove(path)
+            total -= size
+            self._resize(network, -size)
+
+    def compact(self):
+        """Removes the segments whose newest webhook is older than the
+        maximum age"""
+        limit = time.time() - self.max_age
+        with self._lock:
+            for network in self.networks():
+                busy = self._busy(network)
+                for path in self._segments(network):
+                    if path in busy:
+                        continue
+                    if os.path.getmtime(path) < limit:
+                        self.dropped += sum(1 for r in _read_records(path))
+                        size = os.path.getsize(path)
+                        os.remove(path)
+                        self._resize(network, -size)
+
+    def replay(self, network, process):
+        """Calls process(headers, body) for every spooled webhook of
+        <network>, oldest first, until it returns False. Returns whether
+        every webhook was replayed."""
+        while True:
+            with self._lock:
+                # Webhooks received from now on go to a new segment.
+                self._seal(network)
+                segments = self._segments(network)
+                if not segments:
+                    self._pending.discard(network.lower())
+                    return True
+            for path in segments:
+                if not self._replay_segment(network, path, process):
+                    return False
+
+    def _replay_segment(self, network, path, process):
+        with self._lock:
+            if not os.path.exists(path):
+                # Already dropped for the size or age limits
+                return True
+            self._replaying[network.lower()] = path
+            size = os.path.getsize(path)
+        limit = time.time() - self.max_age
+        expired = 0
+        # Bytes of the segment removed from the disk
+        removed = 0
+        try:
+            for offset, timestamp, headers, body in _read_records(path):
+                if timestamp < limit:
+                    expired += 1
+                    continue
+                if process(headers, body) is False:
+                    self._truncate(path, offset)
+                    removed = offset
+                    return False
+            os.remove(path)
+            removed = size
+            return True
+        finally:
+            with self._lock:
+                self._replaying.pop(network.lower(), None)
+                self.dropped += expired
+                self._resize(network, -removed)
+
+    def _truncate(self, path, offset):
+        """Drops the first <offset> bytes of the segment at <path>"""
+        tmp = path + '.tmp'
+        with open(path, 'rb') as source:
+            source.seek(offset)
+            with open(tmp, 'wb') as destination:
+                destination.write(source.read())
+                destination.flush()
+                os.fsync(destination.fileno())
+        os.replace(tmp, path)
+
+    def close(self):
+        with self._lock:
+            for network in list(self._writers):
+                self._seal(network)
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,156 @@
+###
+# Copyright (c) 2015, Moritz Lipp
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+SQLite store of the projects subscribed by channels.
+
+Each subscription is a row keyed by its channel and slug, holding the project
+the same way the plugin used to store it in the registry: either its url or a
+JSON object with its url and settings. Channels are stored in lower case, as
+channel names are case-insensitive.
+"""
+
+import collections
+import json
+import sqlite3
+import threading
+
+from supybot.ircutils import toLower
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS projects (
+    channel TEXT NOT NULL,
+    slug TEXT NOT NULL,
+    entry TEXT NOT NULL,
+    PRIMARY KEY (channel, slug)
+)
+"""
+
+
+class ProjectStore(object):
+
+    """Subscribed projects by channel and slug"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        # Commands and webhooks are handled by different threads.
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(SCHEMA)
+            # Channels used to be stored as given.
+            for (channel,) in self._db.execute(
+                    'SELECT DISTINCT channel FROM projects').fetchall():
+                if toLower(channel) != channel:
+                    self._db.execute(
+                        'UPDATE OR IGNORE projects SET channel = ? '
+                        'WHERE channel = ?', (toLower(channel), channel))
+                    self._db.execute(
+                        'DELETE FROM projects WHERE channel = ?', (channel,))
+
+    def channels(self):
+        """Returns the channels that subscribed to projects"""
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                'SELECT DISTINCT channel FROM projects ORDER BY channel')]
+
+    def projects(self, channel):
+        """Returns the projects of <channel> by slug"""
+        return collections.OrderedDict(self.page(channel))
+
+    def count(self, channel):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM projects WHERE channel = ?',
+                (toLower(channel),)).fetchone()[0]
+
+    def page(self, channel, offset=0, limit=-1):
+        """Returns <limit> (slug, project) of <channel> ordered by slug,
+        starting at <offset>"""
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT slug, entry FROM projects WHERE channel = ? '
+                'ORDER BY slug LIMIT ? OFFSET ?',
+                (toLower(channel), limit, offset)).fetchall()
+        return [(slug, json.loads(entry)) for slug, entry in rows]
+
+    def get(self, channel, slug):
+        """Returns the project <slug> of <channel>, or None"""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT entry FROM projects WHERE channel = ? AND slug = ?',
+                (toLower(channel), slug)).fetchone()
+        return row and json.loads(row[0])
+
+    def set(self, channel, slug, project):
+        self.update({channel: {slug: project}})
+
+    def remove(self, channel, slug):
+        """Removes the project <slug> of <channel> and returns whether it
+        was subscribed"""
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                'DELETE FROM projects WHERE channel = ? AND slug = ?',
+                (toLower(channel), slug))
+        return cursor.rowcount > 0
+
+    def update(self, subscriptions, replace=False):
+        """Adds or replaces the projects of <subscriptions>, a dict of dicts
+        of projects by slug by channel, at once. With <replace>, the other
+        projects of these channels are removed."""
+        with self._lock, self._db:
+            for channel, projects in subscriptions.items():
+                channel = toLower(channel)
+                if replace:
+                    self._db.execute(
+                        'DELETE FROM projects WHERE channel = ?', (channel,))
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO projects (channel, slug, entry) '
+                    'VALUES (?, ?, ?)',
+                    [(channel, slug, json.dumps(project))
+                     for slug, project in projects.items()])
+
+    def export(self):
+        """Returns every subscription as a dict of dicts of projects by slug
+        by channel"""
+        subscriptions = collections.OrderedDict()
+        with self._lock:
+            rows = self._db.execute('SELECT channel, slug, entry '
+                                    'FROM projects ORDER BY channel, slug')
+            for channel, slug, entry in rows:
+                subscriptions.setdefault(channel, collections.OrderedDict())
+                subscriptions[channel][slug] = json.loads(entry)
+        return subscriptions
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -28,11 +28,1379 @@
 
 ###
 
+import copy
+import http.server
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
 from supybot.test import *
+import supybot.httpserver as httpserver
+
+from . import api
+from . import capture
+from . import plugin
+from . import spool
+
+
+def push_payload(homepage, commits=1):
+    return {
+        'object_kind': 'push',
+        'ref': 'refs/heads/master',
+        'user_name': 'John Smith',
+        'project_id': 15,
+        'repository': {'name': 'Diaspora', 'homepage': homepage},
+        'before': '%040x' % 1,
+        'after': '%040x' % 2,
+        'total_commits_count': commits,
+        'commits': [{
+            'id': '%040x' % i,
+            'message': 'Commit %d\n\nDetails' % i,
+            'url': '%s/commit/%040x' % (homepage, i),
+            'author': {'name': 'Jordi Mallach'},
+        } for i in range(commits)],
+    }
+
+
+class FakeRequest(object):
+
+    def __init__(self, headers=None):
+        self.headers = headers or {}
+        self.code = None
+        self.wfile = io.BytesIO()
+
+    def send_response(self, code):
+        self.code = code
+
+    def send_header(self, name, value):
+        pass
+
+    def end_headers(self):
+        pass
+
+
+def issue_payload(homepage, action='open', updated_at=None):
+    return {
+        'object_kind': 'issue',
+        'user': {'name': 'Administrator'},
+        'object_attributes': {
+            'id': 301, 'iid': 23, 'title': 'New API',
+            'project_id': 15, 'action': action,
+            'url': '%s/issues/23' % homepage,
+            'updated_at': updated_at or time.strftime('%Y-%m-%d %H:%M:%S'),
+        },
+    }
+
+
+def pipeline_payload(homepage, status, id=31, ref='master'):
+    return {
+        'object_kind': 'pipeline',
+        'object_attributes': {'id': id, 'ref': ref, 'status': status},
+        'user': {'name': 'Administrator'},
+        'project': {'id': 1, 'name': 'Gitlab Test', 'web_url': homepage},
+    }
+
+
+class ApiStub(http.server.ThreadingHTTPServer):
+
+    """Local server answering like the API of a Gitlab instance"""
+
+    daemon_threads = True
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            server = self.server
+            server.requests.append((self.path, self.client_address,
+                                    self.headers.get('PRIVATE-TOKEN')))
+            time.sleep(server.delay)
+            response = server.responses.get(self.path)
+            body = json.dumps(response).encode('utf-8')
+            self.send_response(404 if response is None else 200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if server.trickle:
+                for i in range(len(body)):
+                    time.sleep(server.trickle)
+                    self.wfile.write(body[i:i + 1])
+            else:
+                self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    def __init__(self):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0),
+                                                 self.Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+        self.requests = []
+        self.responses = {}
+        self.delay = 0
+        # Seconds between each byte of the body
+        self.trickle = 0
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def handle_error(self, request, client_address):
+        # Clients that timed out leave broken pipes behind.
+        pass
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class GitlabTestCase(ChannelPluginTestCase):
+    plugins = ('Gitlab',)
+
+    def setUp(self):
+        super(GitlabTestCase, self).setUp()
+        self.gitlab = self.irc.getCallback('Gitlab')
+        self.gitlab._save_projects({}, self.channel)
+        self.handler = plugin.GitlabHandler(self.gitlab)
+
+    def takeMessages(self):
+        msgs = []
+        msg = self.irc.takeMsg()
+        while msg is not None:
+            msgs.append(msg)
+            msg = self.irc.takeMsg()
+        return msgs
+
+    def addProject(self, slug, url, channel=None):
+        self.assertNotError('gitlab project add %s %s %s' %
+                            (channel or self.channel, slug, url))
+
+    def request(self, headers, body, path='/test'):
+        request = FakeRequest(headers)
+        self.gitlab._webhook.doPost(request, path, body)
+        return request.code
+
+    def post(self, event_type, payload):
+        self.handler.handle_payload({'X-Gitlab-Event': event_type}, payload,
+                                    self.irc)
+        return self.takeMessages()
+
+    def testPushRouting(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        msgs = self.post('Push Hook',
+                         push_payload('http://example.com/mike/diaspora/', 2))
+        self.assertEqual(len(msgs), 3)
+        self.assertTrue(all(m.args[0] == self.channel for m in msgs))
+        self.assertIn('pushed', msgs[0].args[1])
+
+    def testPrefixDoesNotMatch(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        msgs = self.post('Push Hook',
+                         push_payload('https://example.com/mike/diaspora-fork'))
+        self.assertEqual(msgs, [])
+
+    def testRemoveUpdatesIndex(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        self.assertNotError('gitlab project remove diaspora')
+        msgs = self.post('Push Hook',
+                         push_payload('https://example.com/mike/diaspora'))
+        self.assertEqual(msgs, [])
+
+    def testRegistryChangeUpdatesIndex(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        self.gitlab.setRegistryValue(
+            'projects', {'other': 'https://example.com/mike/other'},
+            channel=self.channel)
+        # Added to the projects of the channel
+        self.assertEqual(len(self.post(
+            'Push Hook', push_payload('https://example.com/mike/diaspora'))),
+            2)
+        self.assertEqual(len(self.post(
+            'Push Hook', push_payload('https://example.com/mike/other'))), 2)
+        # The registry value was moved to the store.
+        self.assertEqual(self.gitlab.registryValue('projects', self.channel),
+                         {})
+
+    def testChannelCase(self):
+        url = 'https://example.com/mike/diaspora'
+        self.addProject('diaspora', url, '#Test')
+        self.assertError('gitlab project add #test diaspora %s' % url)
+        self.assertEqual(len(self.post('Push Hook', push_payload(url))), 2)
+        self.assertNotError('gitlab project remove #TEST diaspora')
+        self.assertEqual(self.gitlab._load_projects('#Test'), {})
+
+    def testDieRemovesCallbacks(self):
+        value = self.gitlab.registryValue('projects', self.channel,
+                                          value=False)
+        other = plugin.Gitlab(self.irc)
+        try:
+            other._watch_channel(self.channel)
+            self.assertIn(other._watch_callback,
+                          [callback for callback, args, kwargs
+                           in value._callbacks])
+        finally:
+            other.die()
+            httpserver.hook('gitlab', self.gitlab._webhook)
+        self.assertEqual([callback for callback, args, kwargs
+                          in value._callbacks
+                          if getattr(callback, '__self__', None) is other],
+                         [])
+
+    def testImportExport(self):
+        dirize = conf.supybot.directories.data.dirize
+        with open(dirize('gitlab-import.json'), 'w') as fd:
+            json.dump({'#test': dict(
+                ('p%02d' % i, 'https://example.com/mike/p%d' % i)
+                for i in range(25))}, fd)
+        self.assertRegexp('gitlab project import gitlab-import.json',
+                          '25 project')
+        self.assertRegexp('gitlab project list',
+                          r'^p00: .*, p09: [^,]* \(page 1 of 3\)$')
+        self.assertRegexp('gitlab project list 3',
+                          r'^p20: .*p24: https://example.com/mike/p24 '
+                          r'\(page 3 of 3\)$')
+        self.assertEqual(len(self.post(
+            'Push Hook', push_payload('https://example.com/mike/p7'))), 2)
+
+        self.assertRegexp('gitlab project export gitlab-export.json',
+                          '25 project')
+        with open(dirize('gitlab-export.json')) as fd:
+            self.assertEqual(len(json.load(fd)['#test']), 25)
+        self.assertError('gitlab project import ../gitlab-import.json')
+
+    def testImportInvalid(self):
+        dirize = conf.supybot.directories.data.dirize
+        url = 'https://example.com/mike/diaspora'
+        for settings in ({'token': 42}, {'refs': 'main'}, {'refs': [1]},
+                         {'events': ['commit']}, {'id': '15'},
+                         {'id': True}, {'path': ['mike']}):
+            with open(dirize('gitlab-import.json'), 'w') as fd:
+                json.dump({'#test': {
+                    'client': url + '-client',
+                    'diaspora': dict(settings, url=url)}}, fd)
+            self.assertError('gitlab project import gitlab-import.json')
+            # Nothing is imported
+            self.assertEqual(self.gitlab._load_projects('#test'), {})
+        self.gitlab._build_index()
+
+    def testCaptureReplay(self):
+        url = 'https://example.com/mike/diaspora'
+        self.addProject('diaspora', url)
+        path = conf.supybot.directories.data.dirize('gitlab.capture.gz')
+        service = self.gitlab._webhook
+        service.recorder = capture.Recorder(path, 1024 * 1024)
+        try:
+            for i in range(2):
+                payload = push_payload(url)
+                payload['after'] = '%040x' % (i + 10)
+                self.assertEqual(self.request(
+                    {'X-Gitlab-Event': 'Push Hook'},
+                    json.dumps(payload).encode('utf-8')), 200)
+            # Rejected webhooks are not recorded.
+            self.assertEqual(self.request({'X-Gitlab-Event': 'Push Hook'},
+                                          b'{}', '/unknown'), 403)
+        finally:
+            service.recorder.close()
+            service.recorder = None
+        self.assertEqual(len(self.takeMessages()), 4)
+
+        # Deliveries already announced by the plugin are replayed.
+        self.assertEqual(service.replay(path, 0, self.handler)[:2], (2, 0))
+        self.assertEqual(self.handler.queued, 4)
+        self.assertEqual(len(self.takeMessages()), 4)
+
+        # Skipped when they were already announced on the network
+        self.assertRegexp('gitlab replay test gitlab.capture.gz 0',
+                          r'^2 webhook\(s\) replayed in .* 0 message\(s\) '
+                          r'queued, 0 error\(s\)\.$')
+        self.assertRegexp('gitlab replay --dry-run --duplicates test '
+                          'gitlab.capture.gz 0',
+                          r'^2 webhook\(s\) replayed in .* 4 message\(s\) '
+                          r'not sent, 0 error\(s\)\.$')
+        self.assertEqual(self.takeMessages(), [])
+        self.assertNotError('gitlab replay --duplicates test '
+                            'gitlab.capture.gz 0')
+        msgs = self.takeMessages()
+        self.assertEqual(len(msgs), 4)
+        self.assertIn('4 message(s) queued', msgs[-1].args[1])
+        self.assertError('gitlab replay gitlab.capture.gz 0')
+        self.assertError('gitlab replay unknown gitlab.capture.gz 0')
+        self.assertError('gitlab replay test gitlab.capture.gz -1')
+        self.assertError('gitlab replay test missing.gz')
+
+    def testDryRunReplay(self):
+        url = 'https://example.com/mike/diaspora'
+        path = conf.supybot.directories.data.dirize('gitlab.capture.gz')
+        service = self.gitlab._webhook
+        service.recorder = capture.Recorder(path, 1024 * 1024)
+        try:
+            payload = push_payload(url)
+            payload['project'] = {'path_with_namespace': 'mike/diaspora'}
+            self.assertEqual(self.request(
+                {'X-Gitlab-Event': 'Push Hook'},
+                json.dumps(payload).encode('utf-8')), 200)
+        finally:
+            service.recorder.close()
+            service.recorder = None
+        self.addProject('diaspora', url)
+        metrics = self.gitlab._metrics.render()
+        self.assertRegexp('gitlab replay --dry-run --duplicates test '
+                          'gitlab.capture.gz 0', r'2 message\(s\) not sent')
+        self.assertEqual(self.takeMessages(), [])
+        self.assertEqual(self.gitlab._load_projects('#test')['diaspora'], url)
+        self.assertEqual(self.gitlab._metrics.render(), metrics)
+
+    def testProjectId(self):
+        url = 'https://example.com/mike/diaspora'
+        self.addProject('diaspora', url)
+        self.addProject('diaspora-client', url + '-client')
+        payload = push_payload(url)
+        payload['project'] = {'path_with_namespace': 'mike/diaspora'}
+        token = conf.supybot.plugins.Gitlab.webhook.token.get(':test')
+        with token.context('secret'):
+            self.handler.handle_payload({'X-Gitlab-Event': 'Push Hook',
+                                         'X-Gitlab-Token': 'secret'},
+                                        payload, self.irc)
+        self.assertEqual(len(self.takeMessages()), 2)
+        projects = self.gitlab._load_projects('#test')
+        self.assertEqual(projects['diaspora'],
+                         {'url': url, 'id': 15, 'path': 'mike/diaspora'})
+        self.assertEqual(projects['diaspora-client'], url + '-client')
+
+        # Renamed project
+        payload = push_payload('https://example.com/mike/pod')
+        self.assertEqual(len(self.post('Push Hook', payload)), 2)
+        # Another project now at the old url
+        payload = push_payload(url)
+        payload['project_id'] = 16
+        payload['after'] = '0' * 40
+        self.assertEqual(self.post('Push Hook', payload), [])
+
+        self.assertNotError('gitlab project id diaspora 16')
+        payload['after'] = '1' * 40
+        self.assertEqual(len(self.post('Push Hook', payload)), 2)
+        self.assertNotError('gitlab project id diaspora')
+        self.assertEqual(self.gitlab._load_projects('#test')['diaspora'], url)
+
+    def testForgedProjectId(self):
+        url = 'https://example.com/mike/diaspora'
+        self.addProject('diaspora', url)
+        payload = push_payload(url)
+        payload['project_id'] = 999
+        self.assertEqual(len(self.post('Push Hook', payload)), 2)
+        payload['project'] = {'path_with_namespace': 'eve/forged'}
+        payload['after'] = '0' * 40
+        self.assertEqual(len(self.post('Push Hook', payload)), 2)
+        self.assertEqual(self.gitlab._load_projects('#test')['diaspora'], url)
+
+        # The path comes from the sender as well.
+        payload['project'] = {'path_with_namespace': 'mike/diaspora'}
+        payload['after'] = '1' * 40
+        self.assertEqual(len(self.post('Push Hook', payload)), 2)
+        self.assertEqual(self.gitlab._load_projects('#test')['diaspora'], url)
+
+        # Still routed by its url
+        payload = push_payload(url)
+        self.assertEqual(len(self.post('Push Hook', payload)), 2)
+        self.assertRegexp('gitlab project list', 'diaspora: %s$' % url)
+
+        # Learned from webhooks carrying a token
+        self.addProject('diaspora-client', url + '-client')
+        self.assertNotError('gitlab project token diaspora-client secret')
+        payload = push_payload(url + '-client')
+        payload['project_id'] = 16
+        self.handler.handle_payload({'X-Gitlab-Event': 'Push Hook',
+                                     'X-Gitlab-Token': 'secret'},
+                                    payload, self.irc)
+        self.assertEqual(len(self.takeMessages()), 2)
+        self.assertEqual(
+            self.gitlab._load_projects('#test')['diaspora-client']['id'], 16)
+
+    def testPayloadNotMutated(self):
+        url = 'https://example.com/mike/diaspora'
+        self.irc.state.channels['#other'] = irclib.ChannelState()
+        try:
+            self.addProject('diaspora', url)
+            self.addProject('other', url, '#other')
+            payload = push_payload(url, 2)
+            original = copy.deepcopy(payload)
+            msgs = self.post('Push Hook', payload)
+            self.assertEqual(len(msgs), 6)
+            self.assertEqual(payload, original)
+            self.assertIn('[other]', msgs[-1].args[1])
+        finally:
+            self.gitlab._save_projects({}, '#other')
+            del self.irc.state.channels['#other']
+
+    def testSharedMessages(self):
+        url = 'https://example.com/mike/diaspora'
+        self.irc.state.channels['#other'] = irclib.ChannelState()
+        self.irc.state.supported['targmax'] = 'NAMES:1,PRIVMSG:4,NOTICE:4'
+        try:
+            self.addProject('diaspora', url)
+            self.addProject('diaspora', url, '#other')
+            msgs = self.post('Push Hook', push_payload(url))
+            self.assertEqual([msg.args[0] for msg in msgs],
+                             ['#test,#other', '#test,#other'])
+
+            del self.irc.state.supported['targmax']
+            payload = push_payload(url)
+            payload['after'] = '0' * 40
+            msgs = self.post('Push Hook', payload)
+            self.assertEqual(len(msgs), 4)
+            self.assertEqual(set(msg.args[0] for msg in msgs),
+                             set(['#test', '#other']))
+        finally:
+            self.gitlab._save_projects({}, '#other')
+            del self.irc.state.channels['#other']
+            self.irc.state.supported.pop('targmax', None)
+
+    def testSplitTargets(self):
+        self.irc.state.supported['targmax'] = 'PRIVMSG:2,NOTICE:'
+        try:
+            channels = ['#a', '#b', '#c']
+            self.assertEqual(plugin.split_targets(self.irc, 'PRIVMSG',
+                                                  channels, 'hi'),
+                             ['#a,#b', '#c'])
+            self.assertEqual(plugin.split_targets(self.irc, 'NOTICE',
+                                                  channels, 'hi'),
+                             ['#a,#b,#c'])
+            self.assertEqual(plugin.split_targets(self.irc, 'NOTICE',
+                                                  channels, 'x' * 395),
+                             ['#a,#b', '#c'])
+        finally:
+            del self.irc.state.supported['targmax']
+
+    def testFilters(self):
+        url = 'https://example.com/mike/diaspora'
+        self.addProject('diaspora', url)
+        self.assertNotError('gitlab project filter diaspora events push')
+        self.assertNotError('gitlab project filter diaspora refs main '
+                            'release/*')
+        self.assertError('gitlab project filter diaspora events commit')
+        self.assertRegexp('gitlab project list',
+                          r'events: push; refs: main release/\*')
+
+        payload = push_payload(url)
+        self.assertEqual(self.post('Push Hook', payload), [])
+        payload['ref'] = 'refs/heads/release/1.0'
+        self.assertEqual(len(self.post('Push Hook', payload)), 2)
+        self.assertEqual(self.post('Issue Hook', issue_payload(url)), [])
+
+        self.assertNotError('gitlab project filter diaspora '
+                            'exclude-authors "John Smith"')
+        payload['after'] = '0' * 40
+        self.assertEqual(self.post('Push Hook', payload), [])
+        self.assertIn('gitlab_filtered_total{event="Push Hook"} 2',
+                      self.gitlab._metrics.render())
+
+        for rule in ('events', 'refs', 'exclude-authors'):
+            self.assertNotError('gitlab project filter diaspora %s' % rule)
+        self.assertEqual(self.gitlab._load_projects('#test')['diaspora'],
+                         url)
+
+    def testCommitLimit(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        with conf.supybot.plugins.Gitlab.commits.max.context(3):
+            msgs = self.post('Push Hook', push_payload(
+                'https://example.com/mike/diaspora', 5))
+        self.assertEqual(len(msgs), 5)
+        self.assertIn('2 more commit(s)', msgs[-1].args[1])
+        self.assertIn('https://example.com/mike/diaspora/compare/',
+                      msgs[-1].args[1])
+
+    def testCommitCoalescing(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        with conf.supybot.plugins.Gitlab.commits.coalesce.context(True):
+            msgs = self.post('Push Hook', push_payload(
+                'https://example.com/mike/diaspora', 10))
+        self.assertEqual(len(msgs), 1 + 2)
+        self.assertEqual(msgs[1].args[1].count(' | '), 6)
+        self.assertTrue(all(len(str(m)) <= 512 - 100 for m in msgs))
+
+    def testFormatChangeInvalidatesTemplate(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        payload = push_payload('https://example.com/mike/diaspora')
+        self.post('Push Hook', payload)
+        self.assertNotError('config channel plugins.Gitlab.format.commit '
+                            'commit {short_id}')
+        payload['after'] = '%040x' % 3
+        self.assertNotError('config channel plugins.Gitlab.use-notices True')
+        msgs = self.post('Push Hook', payload)
+        self.assertEqual(msgs[1].command, 'NOTICE')
+        self.assertEqual(msgs[1].args[1], 'commit 0000000000')
+        # Only the profile of the current values is kept.
+        self.assertEqual(len(self.handler._profile_ids), 1)
+        self.assertNotError('config channel plugins.Gitlab.use-notices False')
+        self.assertNotError('config channel plugins.Gitlab.format.commit '
+                            '"%s"' % conf.supybot.plugins.Gitlab.format
+                            .commit._default)
+
+    def testDuplicateDelivery(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        payload = push_payload('https://example.com/mike/diaspora')
+        headers = {'X-Gitlab-Event': 'Push Hook',
+                   'X-Gitlab-Event-UUID': '9cdeb9a9-0d1b-4cbd-ba0c'}
+        for i in range(2):
+            self.handler.handle_payload(headers, payload, self.irc)
+        self.assertEqual(len(self.takeMessages()), 2)
+        # Without the header, the pushed revisions identify the push
+        self.assertEqual(len(self.post('Push Hook', payload)), 2)
+        self.assertEqual(self.post('Push Hook', payload), [])
+        payload['after'] = '%040x' % 3
+        self.assertEqual(len(self.post('Push Hook', payload)), 2)
+        self.assertEqual(self.gitlab._metrics.counter(
+            'gitlab_duplicates_total'), {(): 2})
+
+    def testRetriedDelivery(self):
+        url = 'https://example.com/mike/diaspora'
+        self.gitlab._save_projects(
+            {'diaspora': {'url': url, 'token': 'secret'}}, '#test')
+        payload = push_payload(url)
+        headers = {'X-Gitlab-Event': 'Push Hook',
+                   'X-Gitlab-Event-UUID': '9cdeb9a9-0d1b-4cbd-ba0c'}
+        # A rejected delivery does not prevent the next attempt
+        self.handler.handle_payload(
+            dict(headers, **{'X-Gitlab-Token': 'wrong'}), payload, self.irc)
+        self.assertEqual(self.takeMessages(), [])
+        headers['X-Gitlab-Token'] = 'secret'
+
+        # Neither does one that failed to be announced
+        def fail(context, payload):
+            raise ValueError('lost')
+        self.handler._push_hook = fail
+        try:
+            self.assertRaises(ValueError, self.handler.handle_payload,
+                              headers, payload, self.irc)
+        finally:
+            del self.handler._push_hook
+        self.handler.handle_payload(headers, payload, self.irc)
+        self.assertEqual(len(self.takeMessages()), 2)
+        self.handler.handle_payload(headers, payload, self.irc)
+        self.assertEqual(self.takeMessages(), [])
+
+    def testCustomEventType(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        announced = []
+        self.handler._release_hook = \
+            lambda context, payload: announced.append((context, payload))
+        self.handler.register_event_type(plugin.EventType(
+            'Release Hook', lambda payload: payload['project']['web_url'],
+            lambda payload: payload['project']['id'], '_release_hook'))
+        self.post('Release Hook', {'project': {
+            'id': 4, 'web_url': 'https://example.com/mike/diaspora'}})
+        self.assertEqual(len(announced), 1)
+        self.assertEqual(announced[0][0].channels, (self.channel,))
+        self.assertEqual(announced[0][1]['project']['name'], 'diaspora')
+        event_type = self.handler.event_types['Release Hook']
+        self.assertEqual((event_type.received, event_type.routed), (1, 1))
+
+    def testPipelineTransitions(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        url = 'https://example.com/mike/diaspora'
+        announced = []
+        for id, status in enumerate(('running', 'success', 'failed',
+                                     'running', 'failed', 'success',
+                                     'success')):
+            msgs = self.post('Pipeline Hook',
+                             pipeline_payload(url, status, id))
+            announced.extend(m.args[1].split()[5] for m in msgs)
+        self.assertEqual(announced, ['failed', 'failed', 'fixed'])
+
+    def testPipelineTransitionsPerNetwork(self):
+        url = 'https://example.com/mike/diaspora'
+        self.addProject('diaspora', url)
+        # Another instance, with a project of the same id
+        self.addProject('mirror', 'https://other.example.com/mike/diaspora')
+        conf.registerNetwork('othernet')
+        other = getTestIrc('othernet')
+        try:
+            other.state.channels['#test'] = irclib.ChannelState()
+            for id, (homepage, status) in enumerate((
+                    (url, 'failed'),
+                    ('https://other.example.com/mike/diaspora', 'success'),
+                    (url, 'success'))):
+                body = json.dumps(pipeline_payload(homepage, status, id)) \
+                    .encode('utf-8')
+                for network in ('test', 'othernet'):
+                    self.assertEqual(self.request(
+                        {'X-Gitlab-Event': 'Pipeline Hook'}, body,
+                        '/' + network), 200)
+            announced = [m.args[1].split()[5] for m in self.takeMessages()]
+            self.assertEqual(announced, ['failed', 'fixed'])
+            msgs = []
+            msg = other.takeMsg()
+            while msg is not None:
+                msgs.append(msg)
+                msg = other.takeMsg()
+            self.assertEqual([m.args[1].split()[5] for m in msgs],
+                             ['failed', 'fixed'])
+        finally:
+            other._reallyDie()
+
+    def testJobHook(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        payload = {
+            'object_kind': 'build', 'ref': 'master', 'build_id': 1977,
+            'build_name': 'test', 'build_stage': 'test',
+            'build_status': 'failed', 'project_id': 380,
+            'repository': {'homepage': 'https://example.com/mike/diaspora'},
+        }
+        msgs = self.post('Job Hook', payload)
+        self.assertEqual(len(msgs), 1)
+        self.assertIn('https://example.com/mike/diaspora/-/jobs/1977',
+                      msgs[0].args[1])
+
+    def testDoPost(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        body = json.dumps(push_payload(
+            'https://example.com/mike/diaspora')).encode('utf-8')
+        self.assertEqual(self.request({'X-Gitlab-Event': 'Push Hook'}, body),
+                         200)
+        self.assertEqual(len(self.takeMessages()), 2)
+        self.assertEqual(self.request({}, body, '/unknown'), 403)
+        self.assertEqual(self.request({'X-Gitlab-Event': 'Push Hook'},
+                                      b'{"foo'), 403)
+
+    def testFanOut(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        conf.registerNetwork('othernet')
+        other = getTestIrc('othernet')
+        try:
+            other.state.channels['#test'] = irclib.ChannelState()
+            body = json.dumps(push_payload(
+                'https://example.com/mike/diaspora')).encode('utf-8')
+            self.assertEqual(self.request({'X-Gitlab-Event': 'Push Hook'},
+                                          body, '/'), 200)
+            self.assertEqual(len(self.takeMessages()), 2)
+            msgs = [other.takeMsg(), other.takeMsg()]
+            self.assertEqual([msg.args[0] for msg in msgs if msg],
+                             ['#test', '#test'])
+        finally:
+            other._reallyDie()
+
+    def testFanOutToken(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        conf.registerNetwork('othernet')
+        other = getTestIrc('othernet')
+        token = conf.supybot.plugins.Gitlab.webhook.token.get(':test')
+        try:
+            other.state.channels['#test'] = irclib.ChannelState()
+            payload = push_payload('https://example.com/mike/diaspora')
+            headers = {'X-Gitlab-Event': 'Push Hook'}
+            with token.context('secret'):
+                # Only announced on the network without a token
+                body = json.dumps(payload).encode('utf-8')
+                self.assertEqual(self.request(headers, body, '/'), 200)
+                self.assertEqual(self.takeMessages(), [])
+                self.assertIsNotNone(other.takeMsg())
+                self.assertIsNotNone(other.takeMsg())
+
+                payload['after'] = '%040x' % 3
+                body = json.dumps(payload).encode('utf-8')
+                self.assertEqual(self.request(
+                    dict(headers, **{'X-Gitlab-Token': 'secret'}), body,
+                    '/'), 200)
+                self.assertEqual(len(self.takeMessages()), 2)
+                self.assertIsNotNone(other.takeMsg())
+                self.assertIsNotNone(other.takeMsg())
+
+                # Rejected when every network expects another token
+                with conf.supybot.plugins.Gitlab.webhook.token \
+                        .get(':othernet').context('other'):
+                    self.assertEqual(self.request(headers, body, '/'), 403)
+        finally:
+            other._reallyDie()
+
+    def testConcurrentNetworks(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        self.addProject('other', 'https://example.com/mike/other', '#other')
+        conf.registerNetwork('othernet')
+        other = getTestIrc('othernet')
+        errors = []
+
+        def post(network, url, project_id, thread):
+            payload = push_payload(url, 3)
+            payload['project_id'] = project_id
+            for i in range(50):
+                payload['after'] = '%040x' % (thread * 50 + i)
+                body = json.dumps(payload).encode('utf-8')
+                code = self.request({'X-Gitlab-Event': 'Push Hook'}, body,
+                                    '/' + network)
+                if code != 200:
+                    errors.append(code)
+
+        try:
+            other.state.channels['#other'] = irclib.ChannelState()
+            threads = []
+            for i in range(4):
+                for args in (('test', 'https://example.com/mike/diaspora', 15),
+                             ('othernet', 'https://example.com/mike/other',
+                              16)):
+                    threads.append(threading.Thread(target=post,
+                                                    args=args + (i,)))
+            # Switch threads as often as possible to make races likely.
+            interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-6)
+            try:
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            finally:
+                sys.setswitchinterval(interval)
+            self.assertEqual(errors, [])
+
+            msgs = self.takeMessages()
+            self.assertEqual(len(msgs), 4 * 50 * 4)
+            self.assertEqual(set(msg.args[0] for msg in msgs), {'#test'})
+            msgs = []
+            msg = other.takeMsg()
+            while msg is not None:
+                msgs.append(msg)
+                msg = other.takeMsg()
+            self.assertEqual(len(msgs), 4 * 50 * 4)
+            self.assertEqual(set(msg.args[0] for msg in msgs), {'#other'})
+            self.assertEqual(self.gitlab._webhook.gitlab.queued, 2 * 800)
+        finally:
+            other._reallyDie()
+            self.gitlab._save_projects({}, '#other')
+
+    def testApiEnrichment(self):
+        stub = ApiStub()
+        url = stub.url + '/mike/diaspora'
+        self.handler.api = api.Client(lambda: 'secret', 0.5, 10, 60, 2)
+        try:
+            self.addProject('diaspora', url)
+            payload = push_payload(url)
+            payload['project'] = {'path_with_namespace': 'mike/diaspora'}
+            stub.responses['/api/v4/projects/15/repository/commits/%040x' %
+                           2] = {'last_pipeline': {'status': 'running'}}
+            # Not read for an id anyone may send
+            msgs = self.post('Push Hook', payload)
+            self.assertNotIn('(pipeline', msgs[0].args[1])
+            self.assertEqual(stub.requests, [])
+
+            self.assertNotError('gitlab project id diaspora 15')
+            payload['before'] = '%040x' % 3
+            msgs = self.post('Push Hook', payload)
+            self.assertIn('(pipeline \x02running\x02)', msgs[0].args[1])
+            self.assertEqual(stub.requests[0][2], 'secret')
+
+            payload = {
+                'object_kind': 'merge_request',
+                'user': {'name': 'Administrator'},
+                'project': {'path_with_namespace': 'mike/diaspora'},
+                'object_attributes': {
+                    'id': 99, 'iid': 1, 'title': 'MS-Viewport',
+                    'target_project_id': 15, 'action': 'open',
+                    'url': url + '/merge_requests/1',
+                    'target': {'web_url': url},
+                },
+            }
+            stub.responses['/api/v4/projects/15/merge_requests/1/approvals'] \
+                = {'approved_by': [{'user': {'name': 'John'}}],
+                   'approvals_required': 2, 'approvals_left': 1}
+            msgs = self.post('Merge Request Hook', payload)
+            self.assertIn('(1/2 approvals)', msgs[0].args[1])
+
+            # Unknown resources and slow responses are not waited for.
+            payload['object_attributes'].update(id=100, iid=2)
+            msgs = self.post('Merge Request Hook', payload)
+            self.assertNotIn('approvals', msgs[0].args[1])
+            stub.delay = 2
+            payload['object_attributes'].update(id=101, iid=3)
+            start = time.monotonic()
+            msgs = self.post('Merge Request Hook', payload)
+            self.assertLess(time.monotonic() - start, 1.5)
+            self.assertNotIn('approvals', msgs[0].args[1])
+            self.assertEqual(self.handler.api.counts['timeout'], 1)
+        finally:
+            self.handler.api.close()
+            stub.stop()
+
+    def testApiTarget(self):
+        stub = ApiStub()
+        url = stub.url + '/mike/diaspora'
+        self.handler.api = api.Client(lambda: 'secret', 0.5, 10, 60, 2)
+        try:
+            self.addProject('diaspora', url)
+            self.assertNotError('gitlab project id diaspora 15')
+            stub.responses['/api/v4/projects/15/repository/commits/%040x' %
+                           2] = {'last_pipeline': {'status': 'running'}}
+            # The API is the one of the subscribed url, whatever the scheme
+            # of the url sent in the payload.
+            payload = push_payload(url.replace('http://', 'https://'))
+            msgs = self.post('Push Hook', payload)
+            self.assertIn('(pipeline \x02running\x02)', msgs[0].args[1])
+            self.assertEqual(len(stub.requests), 1)
+
+            # Not read when the enriched format is not used
+            payload['after'] = '%040x' % 3
+            with conf.supybot.plugins.Gitlab.format.get('push-enriched') \
+                    .context(''):
+                self.assertEqual(len(self.post('Push Hook', payload)), 2)
+            payload = {
+                'object_kind': 'merge_request',
+                'user': {'name': 'Administrator'},
+                'object_attributes': {
+                    'id': 99, 'iid': 1, 'title': 'MS-Viewport',
+                    'target_project_id': 15, 'action': 'close',
+                    'url': url + '/merge_requests/1',
+                    'target': {'web_url': url},
+                },
+            }
+            self.assertEqual(len(self.post('Merge Request Hook', payload)), 1)
+            with conf.supybot.plugins.Gitlab.digest.interval.context(60):
+                payload['object_attributes']['action'] = 'open'
+                self.assertEqual(self.post('Merge Request Hook', payload), [])
+            self.assertEqual(len(stub.requests), 1)
+        finally:
+            self.handler.api.close()
+            stub.stop()
+
+    def testToken(self):
+        url = 'https://example.com/mike/diaspora'
+        self.gitlab._save_projects(
+            {'diaspora': {'url': url, 'token': 'secret'}}, '#test')
+        payload = push_payload(url)
+        body = json.dumps(payload).encode('utf-8')
+        headers = {'X-Gitlab-Event': 'Push Hook'}
+        self.assertEqual(self.request(
+            dict(headers, **{'X-Gitlab-Token': 'wrong'}), body), 403)
+        self.assertEqual(self.request(
+            dict(headers, **{'X-Gitlab-Token': 'secret'}), body), 200)
+        self.assertEqual(len(self.takeMessages()), 2)
+
+        # Accepted, but not announced to the channel that expects a token
+        payload['after'] = '0' * 40
+        body = json.dumps(payload).encode('utf-8')
+        self.assertEqual(self.request(headers, body), 200)
+        self.assertEqual(self.takeMessages(), [])
+        with conf.supybot.plugins.Gitlab.webhook.requireToken.context(True):
+            self.assertEqual(self.request(headers, body), 403)
+
+        network = conf.supybot.plugins.Gitlab.webhook.token.get(':test')
+        with network.context('network'):
+            self.assertEqual(self.request(
+                dict(headers, **{'X-Gitlab-Token': 'secret'}), body), 403)
+
+    def testTokenCommand(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        self.assertNotError('gitlab project token diaspora secret')
+        projects = self.gitlab._load_projects('#test')
+        self.assertEqual(projects['diaspora']['token'], 'secret')
+        self.assertRegexp('gitlab project list',
+                          'diaspora: https://example.com/mike/diaspora')
+        self.assertNotError('gitlab project token diaspora')
+        self.assertEqual(self.gitlab._load_projects('#test')['diaspora'],
+                         'https://example.com/mike/diaspora')
+
+    def testMetrics(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        body = json.dumps(push_payload(
+            'https://example.com/mike/diaspora', 3)).encode('utf-8')
+        self.request({'X-Gitlab-Event': 'Push Hook'}, body)
+        self.request({'X-Gitlab-Event': 'Push Hook'}, b'{"foo')
+        self.takeMessages()
+
+        metrics = self.gitlab._metrics.render()
+        self.assertIn('gitlab_webhooks_total{event="Push Hook"} 1', metrics)
+        self.assertIn('gitlab_errors_total{kind="invalid_json"} 1', metrics)
+        self.assertIn('gitlab_messages_per_event_bucket{le="5.0"} 1',
+                      metrics)
+        self.assertIn('gitlab_parse_seconds_count 1', metrics)
+        self.assertIn('gitlab_events_routed_total{event="Push Hook"} 1',
+                      metrics)
+
+        request = FakeRequest()
+        self.gitlab._webhook.doGet(request, '/metrics')
+        self.assertEqual(request.code, 200)
+        self.assertEqual(request.wfile.getvalue().decode('utf-8'), metrics)
+
+        self.assertRegexp('gitlab stats',
+                          r'Webhooks: 1 \(Push Hook: 1\); '
+                          r'Errors: 1 \(invalid_json: 1\); '
+                          r'Messages queued: 4')
+
+    def testSpoolDisconnectedNetwork(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        service = self.gitlab._webhook
+        service.spool = spool.Spool(directory, 1000, 10000, 3600, 0)
+        self.addCleanup(setattr, service, 'spool', None)
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        payload = push_payload('https://example.com/mike/diaspora')
+        body = json.dumps(payload).encode('utf-8')
+        headers = {'X-Gitlab-Event': 'Push Hook'}
+
+        with conf.supybot.networks.context(set(['test', 'offline'])):
+            self.assertEqual(self.request(headers, body, '/offline'), 202)
+            # Form fields parsed by the HTTP server
+            self.assertEqual(self.request(headers, {'a': 'b'}, '/offline'),
+                             403)
+        self.assertEqual(self.request(headers, body, '/unknown'), 403)
+        self.assertEqual(service.spool.networks(), ['offline'])
+
+        # Webhooks wait for older ones while the spool is not replayed.
+        self.irc.afterConnect = True
+        service.spool.append('test', headers, body)
+        payload['after'] = '%040x' % 3
+        body = json.dumps(payload).encode('utf-8')
+        self.assertEqual(self.request(headers, body), 202)
+        self.assertEqual(self.takeMessages(), [])
+        service._replay_spool('test')
+        self.assertEqual(len(self.takeMessages()), 4)
+        self.assertFalse(service.spool.pending('test'))
+
+    def testSpoolNetworkToken(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        service = self.gitlab._webhook
+        service.spool = spool.Spool(directory, 1000, 10000, 3600, 0)
+        self.addCleanup(setattr, service, 'spool', None)
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        body = json.dumps(push_payload(
+            'https://example.com/mike/diaspora')).encode('utf-8')
+        wrong = {'X-Gitlab-Event': 'Push Hook', 'X-Gitlab-Token': 'wrong'}
+
+        token = conf.supybot.plugins.Gitlab.webhook.token
+        with conf.supybot.networks.context(set(['test', 'offline'])), \
+                token.get(':offline').context('netsecret'):
+            self.assertEqual(self.request(wrong, body, '/offline'), 403)
+        self.assertEqual(service.spool.networks(), [])
+
+        # Spooled before the token of the network was set
+        self.irc.afterConnect = True
+        service.spool.append('test', wrong, body)
+        with token.get(':test').context('netsecret'):
+            service._replay_spool('test')
+        self.assertEqual(self.takeMessages(), [])
+
+    def testMaxSize(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        body = json.dumps(push_payload(
+            'https://example.com/mike/diaspora')).encode('utf-8')
+        with conf.supybot.plugins.Gitlab.webhook.maxSize.context(100):
+            self.assertEqual(self.request(
+                {'X-Gitlab-Event': 'Push Hook'}, body), 413)
+            self.assertEqual(self.request(
+                {'X-Gitlab-Event': 'Push Hook', 'Content-Length': '10000'},
+                b'{}'), 413)
+        self.assertEqual(self.takeMessages(), [])
+
+    def testIssueRouting(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        msgs = self.post('Issue Hook', issue_payload(
+            'https://example.com/mike/diaspora'))
+        self.assertEqual(len(msgs), 1)
+        self.assertIn('New API', msgs[0].args[1])
+
+    def testCoalescedUpdates(self):
+        self.addProject('diaspora', 'https://example.com/mike/diaspora')
+        url = 'https://example.com/mike/diaspora'
+        with conf.supybot.plugins.Gitlab.coalesce.window.context(60):
+            for i in range(3):
+                self.assertEqual(self.post(
+                    'Issue Hook', issue_payload(url, 'update', i)), [])
+            self.assertEqual(len(self.handler.debouncer), 1)
+            # The pending updates are announced before the issue is closed.
+            msgs = self.post('Issue Hook', issue_payload(url, 'close'))
+            self.assertEqual(len(msgs), 2)
+            self.assertIn('updated', msgs[0].args[1])
+            self.assertIn('(3x)', msgs[0].args[1])
+            self.assertIn('closed', msgs[1].args[1])
+            self.assertEqual(len(self.handler.debouncer), 0)
+
+            self.assertEqual(self.post(
+                'Issue Hook', issue_payload(url, 'update', 5)), [])
+        self.handler.debouncer.flush()
+        msgs = self.takeMessages()
+        self.assertEqual(len(msgs), 1)
+        self.assertIn('updated', msgs[0].args[1])
+        self.assertNotIn('x)', msgs[0].args[1])
+
+    def testDigest(self):
+        url = 'https://example.com/mike/'
+        for i, slug in enumerate(('diaspora', 'client', 'docs')):
+            self.addProject(slug, url + slug)
+        group = conf.supybot.plugins.Gitlab.digest
+        with group.interval.context(60), group.projects.context(2):
+            for i in range(3):
+                payload = push_payload(url + 'diaspora', 2)
+                payload['after'] = '%040x' % (i + 10)
+                self.assertEqual(self.post('Push Hook', payload), [])
+            self.assertEqual(self.post('Issue Hook', issue_payload(
+                url + 'diaspora')), [])
+            self.assertEqual(self.post('Pipeline Hook', pipeline_payload(
+                url + 'diaspora', 'success')), [])
+            for i, slug in enumerate(('client', 'docs')):
+                payload = push_payload(url + slug)
+                payload['project_id'] = 16 + i
+                self.assertEqual(self.post('Push Hook', payload), [])
+            self.assertEqual(len(self.handler.digest), 1)
+            self.handler.digest.flush()
+        msgs = [msg.args[1] for msg in self.takeMessages()]
+        self.assertEqual(msgs, [
+            '\x02[diaspora]\x02 3 pushes, 6 commits, 1 opened issue; '
+            'by John Smith (3), Administrator (1)',
+            '\x02[client]\x02 1 push, 1 commit; by John Smith (1)',
+            '...and 1 event(s) of other projects'])
+
+    def testDigestPerChannel(self):
+        url = 'https://example.com/mike/'
+        self.irc.state.channels['#other'] = irclib.ChannelState()
+        try:
+            self.addProject('diaspora', url + 'diaspora')
+            self.addProject('diaspora', url + 'diaspora', '#other')
+            self.addProject('client', url + 'client', '#other')
+            group = conf.supybot.plugins.Gitlab.digest
+            with group.interval.context(60), group.projects.context(1):
+                self.assertEqual(self.post('Push Hook', push_payload(
+                    url + 'diaspora')), [])
+                payload = push_payload(url + 'client')
+                payload['project_id'] = 16
+                self.assertEqual(self.post('Push Hook', payload), [])
+                # Whatever the channels the projects are announced with
+                self.assertEqual(len(self.handler.digest), 2)
+                self.handler.digest.flush()
+            msgs = sorted((msg.args[0], msg.args[1])
+                          for msg in self.takeMessages())
+            self.assertEqual(msgs, [
+                ('#other', '\x02[diaspora]\x02 1 push, 1 commit; '
+                           'by John Smith (1)'),
+                ('#other', '...and 1 event(s) of other projects'),
+                ('#test', '\x02[diaspora]\x02 1 push, 1 commit; '
+                          'by John Smith (1)')])
+        finally:
+            self.gitlab._save_projects({}, '#other')
+            del self.irc.state.channels['#other']
+
+
+class CaptureTestCase(SupyTestCase):
+
+    def setUp(self):
+        super(CaptureTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'capture.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(CaptureTestCase, self).tearDown()
+
+    def testRecord(self):
+        recorder = capture.Recorder(self.path, 1024 * 1024, 0)
+        recorder.record('test', {'X-Gitlab-Event': 'Push Hook'}, b'{}')
+        recorder.record(None, {}, b'\xff')
+        # Readable while recording
+        records = list(capture.read(self.path))
+        self.assertEqual([(record['network'], capture.body(record))
+                          for record in records],
+                         [('test', b'{}'), (None, b'\xff')])
+        recorder.close()
+        # Appended to the capture, up to its maximum size
+        recorder = capture.Recorder(self.path, 1024 * 1024, 0)
+        recorder._max_size = recorder._raw.tell() + 1
+        recorder.record('test', {}, b'[]')
+        recorder.record('test', {}, b'[1]')
+        recorder.close()
+        self.assertEqual((recorder.recorded, recorder.dropped), (1, 1))
+        self.assertEqual([capture.body(record)
+                          for record in capture.read(self.path)],
+                         [b'{}', b'\xff', b'[]'])
+
+    def testReplaySpeed(self):
+        records = [{'time': 100 + offset} for offset in (0, 1, 3)]
+        processed = []
+        sleeps = []
+        count, elapsed = capture.replay(records, processed.append, 2,
+                                        sleeps.append)
+        self.assertEqual(count, 3)
+        self.assertEqual(processed, records)
+        self.assertEqual([round(delay, 1) for delay in sleeps], [0.5, 1.5])
+        sleeps = []
+        capture.replay(records, processed.append, 0, sleeps.append)
+        self.assertEqual(sleeps, [])
+
+
+class TopCounterTestCase(SupyTestCase):
+
+    def testBounded(self):
+        counter = plugin.TopCounter(3)
+        for author in 'aaaaabbbcdefa':
+            counter.add(author)
+        self.assertEqual(len(counter._counts), 3)
+        self.assertEqual(counter.most_common(1), [('a', 6)])
+
+
+class WebhookQueueTestCase(SupyTestCase):
+
+    def _blockedQueue(self, policy):
+        started = threading.Event()
+        self.release = threading.Event()
+        self.processed = []
+
+        def process(item):
+            started.set()
+            self.release.wait()
+            self.processed.append(item)
+
+        queue = plugin.WebhookQueue(process, 2, 1, policy)
+        queue.put(('first',))
+        started.wait()
+        return queue
+
+    def tearDown(self):
+        self.release.set()
+        super(WebhookQueueTestCase, self).tearDown()
+
+    def testReject(self):
+        queue = self._blockedQueue('reject')
+        self.assertTrue(queue.put(('second',)))
+        self.assertTrue(queue.put(('third',)))
+        self.assertFalse(queue.put(('fourth',)))
+        self.assertEqual(queue.rejected, 1)
+        self.assertEqual(len(queue), 2)
+        # Acknowledged webhooks are processed before the workers stop.
+        self.release.set()
+        queue.stop()
+        self.assertEqual(self.processed, ['first', 'second', 'third'])
+        self.assertFalse(queue.put(('fifth',)))
+
+    def testStopTimeout(self):
+        queue = self._blockedQueue('reject')
+        queue.put(('second',))
+        queue.stop(0.1)
+        self.assertEqual((len(queue), queue.dropped), (0, 1))
+
+    def testDropOldest(self):
+        queue = self._blockedQueue('drop-oldest')
+        for item in ('second', 'third', 'fourth'):
+            self.assertTrue(queue.put((item,)))
+        self.assertEqual(queue.dropped, 1)
+        self.release.set()
+        while len(queue):
+            time.sleep(0.01)
+        queue.stop()
+        self.assertEqual(self.processed, ['first', 'third', 'fourth'])
+
+
+class ApiClientTestCase(SupyTestCase):
+
+    def setUp(self):
+        super(ApiClientTestCase, self).setUp()
+        self.stub = ApiStub()
+        for i in range(3):
+            self.stub.responses['/api/v4/projects/1/issues/%d' % i] = \
+                {'iid': i}
+        self.client = api.Client(lambda: '', 0.5, 2, 60, 2)
+
+    def tearDown(self):
+        self.client.close()
+        self.stub.stop()
+        super(ApiClientTestCase, self).tearDown()
+
+    def testCache(self):
+        for i in (0, 0, 1, 2, 0):
+            self.assertEqual(self.client.get(self.stub.url, 1,
+                                             'issues/%d' % i), {'iid': i})
+        # The least recently used response was dropped.
+        self.assertEqual([path for path, address, token in
+                          self.stub.requests],
+                         ['/api/v4/projects/1/issues/%d' % i
+                          for i in (0, 1, 2, 0)])
+        # Over a single connection
+        self.assertEqual(len(set(address for path, address, token in
+                                 self.stub.requests)), 1)
+        self.assertEqual(self.client.counts['hit'], 1)
+        self.assertRaises(api.ApiError, self.client.get, self.stub.url, 1,
+                          'issues/3')
+
+    def testCoalescing(self):
+        self.stub.delay = 0.2
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            self.client.get(self.stub.url, 1, 'issues/1')))
+            for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [{'iid': 1}] * 5)
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertEqual(self.client.counts['coalesced'], 4)
+
+    def testTimeout(self):
+        self.stub.delay = 2
+        start = time.monotonic()
+        self.assertRaises(api.ApiTimeout, self.client.get, self.stub.url, 1,
+                          'issues/1')
+        self.assertLess(time.monotonic() - start, 1.5)
+        # The connection is not reused after a timeout.
+        self.stub.delay = 0
+        self.assertEqual(self.client.get(self.stub.url, 1, 'issues/1'),
+                         {'iid': 1})
+
+    def testTrickledResponse(self):
+        # Each byte arrives within the timeout, but not the whole body.
+        self.stub.trickle = 0.1
+        start = time.monotonic()
+        self.assertRaises(api.ApiTimeout, self.client.get, self.stub.url, 1,
+                          'issues/1')
+        self.assertLess(time.monotonic() - start, 1)
+
+    def testInstanceUrl(self):
+        self.assertEqual(api.instance_url('https://example.com/mike/diaspora',
+                                          'mike/diaspora'),
+                         'https://example.com')
+        self.assertEqual(api.instance_url(
+            'https://example.com/gitlab/mike/diaspora/', 'mike/diaspora'),
+            'https://example.com/gitlab')
+
+
+class OutboundSchedulerTestCase(SupyTestCase):
+
+    class Irc(object):
+
+        def __init__(self):
+            self.sent = []
+
+        def queueMsg(self, msg):
+            self.sent.append(msg)
+
+    def testOrder(self):
+        irc = self.Irc()
+        # Nothing is sent before the scheduler is stopped.
+        scheduler = plugin.OutboundScheduler(lambda: 1e-6, 0)
+        bulk = plugin.OutboundScheduler.BULK
+        normal = plugin.OutboundScheduler.NORMAL
+        for i in range(2):
+            scheduler.put(irc, '#a', 'commit %d' % i, bulk)
+        for i in range(2):
+            scheduler.put(irc, '#c', 'c%d' % i, normal)
+        for i in range(2):
+            scheduler.put(irc, '#d', 'd%d' % i, normal)
+        scheduler.put(irc, '#b', 'merged', plugin.OutboundScheduler.URGENT)
+        self.assertEqual(len(scheduler), 7)
+        scheduler.stop()
+        self.assertEqual(irc.sent, ['merged', 'c0', 'd0', 'c1', 'd1',
+                                    'commit 0', 'commit 1'])
+
+    def testRate(self):
+        irc = self.Irc()
+        scheduler = plugin.OutboundScheduler(lambda: 200, 1)
+        start = time.monotonic()
+        for i in range(10):
+            scheduler.put(irc, '#a', i, plugin.OutboundScheduler.NORMAL)
+        while len(irc.sent) < 10 and time.monotonic() - start < 5:
+            time.sleep(0.01)
+        elapsed = time.monotonic() - start
+        scheduler.stop()
+        self.assertEqual(irc.sent, list(range(10)))
+        self.assertEqual(scheduler.sent, 10)
+        self.assertGreater(elapsed, 9 / 200.)
+
+
+class SpoolTestCase(SupyTestCase):
+
+    def setUp(self):
+        super(SpoolTestCase, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(SpoolTestCase, self).tearDown()
+
+    def spool(self, segment_size=100, max_size=10000, max_age=3600):
+        return spool.Spool(self.directory, segment_size, max_size, max_age,
+                           sync_interval=0)
+
+    def replay(self, queue, network='net'):
+        replayed = []
+        queue.replay(network, lambda headers, body: replayed.append(
+            (headers['n'], body)))
+        return replayed
+
+    def testReplayInOrder(self):
+        queue = self.spool()
+        for i in range(10):
+            queue.append('Net', {'n': i}, b'x' * i)
+        self.assertEqual(queue.networks(), ['net'])
+        self.assertTrue(queue.pending('net'))
+        self.assertEqual(self.replay(queue),
+                         [(i, b'x' * i) for i in range(10)])
+        self.assertFalse(queue.pending('net'))
+        self.assertEqual(queue.networks(), [])
+
+    def testInterruptedReplay(self):
+        queue = self.spool(segment_size=10000)
+        for i in range(5):
+            queue.append('net', {'n': i}, b'')
+        replayed = []
+
+        def process(headers, body):
+            if headers['n'] == 3:
+                return False
+            replayed.append(headers['n'])
+        self.assertFalse(queue.replay('net', process))
+        self.assertEqual(replayed, [0, 1, 2])
+        queue.close()
+        # A new spool, as after a restart, picks up where replay stopped.
+        queue = self.spool()
+        self.assertTrue(queue.pending('net'))
+        self.assertEqual([n for n, body in self.replay(queue)], [3, 4])
+
+    def testTruncatedRecord(self):
+        queue = self.spool(segment_size=10000)
+        queue.append('net', {'n': 0}, b'body')
+        queue.close()
+        path = os.path.join(self.directory, 'net',
+                            os.listdir(os.path.join(self.directory, 'net'))[0])
+        with open(path, 'ab') as fd:
+            fd.write(b'\x00\x01')
+        self.assertEqual(self.replay(self.spool()), [(0, b'body')])
+
+    def testMaxSize(self):
+        queue = self.spool(segment_size=50, max_size=200)
+        for i in range(20):
+            queue.append('net', {'n': i}, b'x' * 20)
+        replayed = [n for n, body in self.replay(queue)]
+        self.assertEqual(replayed, list(range(20 - len(replayed), 20)))
+        self.assertEqual(queue.dropped, 20 - len(replayed))
+
+    def testMaxSizeDuringReplay(self):
+        queue = self.spool(segment_size=50, max_size=200)
+        for i in range(3):
+            queue.append('net', {'n': i}, b'x' * 20)
+        replayed = []
 
+        def process(headers, body):
+            replayed.append(headers['n'])
+            if headers['n'] == 0:
+                # Received meanwhile, dropping the oldest segments
+                for i in range(3, 25):
+                    queue.append('net', {'n': i}, b'x' * 20)
+        self.assertTrue(queue.replay('net', process))
+        self.assertEqual(replayed[0], 0)
+        # Every webhook is either replayed or dropped, once.
+        self.assertEqual(sorted(replayed), sorted(set(replayed)))
+        self.assertEqual(len(replayed) + queue.dropped, 25)
+        self.assertEqual(replayed[-1], 24)
+        # The size kept of the segments follows what is on the disk.
+        self.assertEqual(queue._sizes['net'], 0)
 
-class TaigaTestCase(PluginTestCase):
-    plugins = ('Taiga',)
+    def testMaxAge(self):
+        queue = self.spool(max_age=60)
+        queue.append('net', {'n': 0}, b'')
+        queue.max_age = -1
+        self.assertEqual(self.replay(queue), [])
+        self.assertEqual(queue.dropped, 1)
 
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79: